@@ -6,10 +6,13 @@ from app.device.screen import Screen
 from app.device.camera import Camera
 from app.parser import SessionReader
 from app.estimation.persondetector import PersonDetector
+from app.estimation.store import EyePatchStore
 from app.frame import Frame
 from app.actor import Person
 from app import *
 from tqdm import tqdm
+from numpy import empty
+from numpy import uint8
 
 import cv2
 
@@ -38,24 +41,130 @@ class Scene:
             ) for name, screen_data in intrinsic_params['SCREENS'].items()
         }
 
+        # precomposed transforms between objects of the scene, see get_transform
+        self._transforms = {}
+
+    def get_object(self, name):
+        if name in self.cams:
+            return self.cams[name]
+        if name in self.screens:
+            return self.screens[name]
+        raise Exception(f'There is no camera or screen "{name}" in the scene.')
+
+    def get_transform(self, source, target):
+        """
+        4x4 matrix which maps homogeneous coordinates in space of `source` to space of `target`,
+        e.g. get_transform('wall', 'basler') or get_transform('color', 'basler').
+        Transforms are composed once, and recomposed only if extrinsics of the objects were changed.
+        :param source: name of camera or screen
+        :param target: name of camera or screen
+        :return: array 4x4
+        """
+        source_matrix = self.get_object(source).restore_extrinsic_matrix()
+        target_matrix = self.get_object(target).restore_inverse_extrinsic_matrix()
+        cached = self._transforms.get((source, target))
+        if cached is None or cached[0] is not source_matrix or cached[1] is not target_matrix:
+            transform = target_matrix @ source_matrix
+            transform.flags.writeable = False
+            cached = self._transforms[(source, target)] = source_matrix, target_matrix, transform
+        return cached[2]
+
+    def vectors_to(self, vectors, source, target):
+        """
+        Maps vectors 3xN from space of `source` to space of `target`.
+        """
+        transform = self.get_transform(source, target)
+        return transform[:3, :3] @ vectors.reshape(3, -1) + transform[:3, 3:]
+
     def to_dict(self):
         return {'screens':  {name: screen.to_dict() for name, screen in self.screens.items()},
                 'cams': {name: cam.to_dict() for name, cam in self.cams.items()}}
 
 
-def create_learning_dataset(save_path, sess_reader, face_detector, scene, indices=None, markers=None):
+def save_eye_patches(save_path, store, index, person, camera, left_eye_frame, right_eye_frame):
+    """
+    Saves eye patches of a snapshot.
+    :return: names of png files or rows of EyePatchStore if store is given
+    """
+    if store is not None:
+        pose = person.get_norm_rotation(camera)
+        return store.append(left_eye_frame, person.get_norm_gaze('left', camera), pose), \
+               store.append(right_eye_frame, person.get_norm_gaze('right', camera), pose)
+
+    cv2.imwrite(Path.join(save_path, f'{index}_left.png'), left_eye_frame)
+    cv2.imwrite(Path.join(save_path, f'{index}_right.png'), right_eye_frame)
+    return f'{index}_left.png', f'{index}_right.png'
+
+
+class LearningDatasetWriter:
+    """
+    Writes normalized_dataset.json item by item, so the dataset is not kept in memory.
+    The file is a valid json only after `close`.
+
+    Examples
+    --------
+
+    >>> with LearningDatasetWriter(save_path, scene) as writer:
+    >>>     writer.append(person.to_learning_dataset(left_image, right_image, camera))
+    """
+
+    def __init__(self, save_path, scene, file_name='normalized_dataset.json'):
+        self.path = Path.join(save_path, file_name)
+        self.scene = scene.to_dict()
+        self.size = 0
+        self.file = open(self.path, mode='w')
+        self.file.write('{\n  "dataset": [')
+
+    def append(self, item):
+        self.file.write((',\n    ' if self.size else '\n    ') + json.dumps(item))
+        self.size += 1
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write('\n  ],\n  "scene": ' + json.dumps(self.scene) + '\n}\n')
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def create_learning_dataset(save_path, sess_reader, face_detector, scene, indices=None, markers=None, prefetch=0,
+                            use_store=True, batch_size=64, processes=None):
     save_path = Path.join(save_path, 'normalized_data', sess_reader.session_code)
     if not os.path.exists(save_path):
         os.makedirs(save_path, exist_ok=True)
     print(save_path)
 
+    # eye patches are appended to EyePatchStore, or saved as png files
+    store = EyePatchStore(save_path) if use_store else None
+    # eye patches are extracted into one buffer, they are saved before the next snapshot
+    eyes_buffer = empty((2, 72, 120), dtype=uint8)
+
     learning_data = {'dataset': [], 'scene': scene.to_dict()}
-    for ((frames, data), index), marker in zip(sess_reader.snapshots_iterate(indices=indices, progress_bar=True), markers):
-        if data['face_points']:
+    # faces are tracked through snapshots of the session, persons of a batch are detected by worker processes,
+    # workers are forked before reading threads are started
+    processes = face_detector.open_pool(processes)
+    face_detector.reset()
+    # snapshots after the last marker are not read
+    if indices is None:
+        indices = range(len(sess_reader.snapshots))
+    indices = indices[:len(markers)]
+    markers = iter(markers)
+    batches = sess_reader.batches_iterate(batch_size, indices=indices, progress_bar=True, prefetch=prefetch,
+                                          cam_names=['basler'])
+    for batch in batches:
+        batch = [(frames, index, marker) for ((frames, data), index), marker in zip(batch, markers)
+                 if data['face_points']]
+        persons_batch = face_detector.detect_persons_batch([frames['basler'] for frames, _, _ in batch],
+                                                           scene.origin, processes=processes)
+        for (frames, index, marker), actors_basler in zip(batch, persons_batch):
             frame_basler = frames['basler']
             # actor_kinect = Person('kinect', origin=scene.origin)
             # actor_kinect.set_kinect_landmarks3d(data['face_points'])
-            actors_basler = face_detector.detect_persons(frame_basler, scene.origin)
             if len(actors_basler) == 0:
                 continue
             actor_basler = actors_basler[0]
@@ -69,15 +178,20 @@ def create_learning_dataset(save_path, sess_reader, face_detector, scene, indice
                                                                                     resolution=(120, 72),
                                                                                     equalize_hist=True,
                                                                                     to_grayscale=True,
-                                                                                    remove_specularity=True)
+                                                                                    remove_specularity=True,
+                                                                                    out=eyes_buffer)
 
-            cv2.imwrite(Path.join(save_path, f'{index}_left.png'), left_eye_frame)
-            cv2.imwrite(Path.join(save_path, f'{index}_right.png'), right_eye_frame)
+            left_image, right_image = save_eye_patches(save_path, store, index, actor_basler, scene.cams['basler'],
+                                                       left_eye_frame, right_eye_frame)
 
-            learning_data['dataset'].append(actor_basler.to_learning_dataset(f'{index}_left.png',
-                                                                              f'{index}_right.png',
+            learning_data['dataset'].append(actor_basler.to_learning_dataset(left_image,
+                                                                              right_image,
                                                                               scene.cams['basler']))
 
+    if store is not None:
+        store.close()
+    face_detector.close()
+
     with open(Path.join(save_path, 'normalized_dataset.json'), mode='w') as outfile:
         json.dump(learning_data, fp=outfile, indent=2)
     print(f"Dataset saved to {save_path}. Number of useful snapshots: {len(learning_data['dataset'])}")
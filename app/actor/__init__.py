@@ -1,14 +1,69 @@
 from numpy import cross
 from numpy import array
+from numpy import asarray
+from numpy import einsum
 from numpy import sum
 from numpy import abs
 from numpy.linalg import norm
-from numpy.linalg import inv
+from numpy.linalg import solve
 
 from app.device import SceneObj
 from app.parser import quaternion_to_angle_axis
 
-from scipy.optimize import minimize
+
+def fit_sphere_centers(points, radius, initial=None, iterations=10):
+    """
+    Fits centers of spheres with known radius to points on their surfaces,
+    least squares of (|center - point| - radius) solved by Gauss-Newton with fixed number of iterations.
+    :param points: array FxMx3, M points on each of F spheres, or Mx3 for one sphere
+    :param radius: radius of spheres
+    :param initial: initial centers Fx3, None - centroid of points moved by radius away from the origin camera
+    :param iterations: number of Gauss-Newton iterations
+    :return: centers Fx3
+    """
+    points = asarray(points, dtype=float)
+    points = points.reshape(-1, *points.shape[-2:])
+    if initial is None:
+        # points are on the visible side of eyeballs, so centers are farther from the camera
+        centroids = points.mean(axis=1)
+        centers = centroids + radius * centroids / norm(centroids, axis=1, keepdims=True)
+    else:
+        centers = array(initial, dtype=float).reshape(-1, 3)
+
+    for _ in range(iterations):
+        offsets = centers[:, None, :] - points
+        distances = norm(offsets, axis=2)
+        jacobians = offsets / distances[..., None]
+        residuals = distances - radius
+        centers -= solve(einsum('fmi,fmj->fij', jacobians, jacobians),
+                         einsum('fmi,fm->fi', jacobians, residuals)[..., None])[..., 0]
+    return centers
+
+
+def fit_sphere_center_minimize(points, radius, initial):
+    """
+    Previous eyeball center fit, sum of absolute errors minimized by scipy, kept for comparison.
+    """
+    from scipy.optimize import minimize
+
+    points = asarray(points, dtype=float)
+    return minimize(lambda center: sum(abs(norm(center - points, axis=1) - radius)), x0=initial).x
+
+
+def compare_eye_center_fits(face_points_list, radius=0.0135):
+    """
+    Compares eyeball centers of Kinect face points fitted by `fit_sphere_centers` and `fit_sphere_center_minimize`.
+    :param face_points_list: list of Kinect face points of frames
+    :return: distances between centers of two methods in meters, array Fx2 for left and right eye
+    """
+    face_points = asarray(face_points_list, dtype=float)
+    distances = []
+    for eye_indices in [Person.left_eye_center, Person.right_eye_center]:
+        centers = fit_sphere_centers(face_points[:, eye_indices], radius)
+        reference = array([fit_sphere_center_minimize(points[eye_indices], radius, points[eye_indices[0]])
+                           for points in face_points])
+        distances.append(norm(centers - reference, axis=1))
+    return array(distances).T
 
 
 class Person(SceneObj):
@@ -82,10 +137,10 @@ class Person(SceneObj):
         eye_gaze = self.get_eye_gaze(eye=eye)
         eye_gaze = eye_gaze / norm(eye_gaze)
 
-        return inv(camera.get_rotation_matrix()) @ eye_gaze.reshape(3, -1)
+        return camera.get_inverse_rotation_matrix() @ eye_gaze.reshape(3, -1)
 
     def get_norm_rotation(self, camera):
-        return inv(camera.get_rotation_matrix()) @ self.get_face_gaze().reshape(3, -1)
+        return camera.get_inverse_rotation_matrix() @ self.get_face_gaze().reshape(3, -1)
 
     def to_learning_dataset(self, img_left_name, img_right_name, camera):
         return {
@@ -101,19 +156,33 @@ class Person(SceneObj):
             'name': self.name
         }
 
-    def set_kinect_landmarks3d(self, face_points):
+    @classmethod
+    def fit_kinect_eye_centers(cls, face_points, eyeball_radius=0.0135):
+        """
+        Fits eyeball centers to Kinect face points of many frames at once.
+        :param face_points: array Fx1347x3 or 1347x3
+        :return: left and right eyeball centers, arrays Fx3
+        """
+        face_points = asarray(face_points, dtype=float)
+        face_points = face_points.reshape(-1, *face_points.shape[-2:])
+        return fit_sphere_centers(face_points[:, cls.left_eye_center], eyeball_radius), \
+               fit_sphere_centers(face_points[:, cls.right_eye_center], eyeball_radius)
+
+    def set_kinect_landmarks3d(self, face_points, eye_centers=None):
+        """
+        :param face_points: Kinect face points
+        :param eye_centers: left and right eyeball centers from `fit_kinect_eye_centers`, None - fit them here
+        """
         face_points = array(face_points)
 
-        # Function for OLS
-        def objective_function(center, eye):
-            return sum(abs(norm(center - face_points[eye, :], axis=1) - self.eyeball_radius))
+        if eye_centers is None:
+            eye_centers = self.fit_kinect_eye_centers(face_points, self.eyeball_radius)
+        left_eye_center, right_eye_center = eye_centers
 
         self.set_eye_rectangle('left', face_points[[1080, 201, 289, 151]])
         self.set_eye_rectangle('right', face_points[[1084, 847, 947, 772]])
-        self.set_eye_center('left', minimize(lambda x: objective_function(x, self.left_eye_center),
-                                             x0=face_points[self.left_eye_center[0]]).x)
-        self.set_eye_center('right', minimize(lambda x: objective_function(x, self.right_eye_center),
-                                              x0=face_points[self.right_eye_center[0]]).x)
+        self.set_eye_center('left', asarray(left_eye_center).reshape(3))
+        self.set_eye_center('right', asarray(right_eye_center).reshape(3))
         self.set_nose(face_points[18])
         self.set_chin(face_points[4])
         return self
@@ -0,0 +1,228 @@
+from numpy import abs as absolute
+from numpy import add
+from numpy import arctan
+from numpy import concatenate
+from numpy import degrees
+from numpy import diff
+from numpy import empty
+from numpy import flatnonzero
+from numpy import full
+from numpy import hypot
+from numpy import isfinite
+from numpy import nan
+from numpy import repeat
+from numpy import zeros
+from numpy import float64
+from numpy import int8
+from numpy import int64
+
+
+NONE, FIXATION, SACCADE, BLINK = 0, 1, 2, 3
+
+EVENT_DTYPE = [('type', int8), ('first', int64), ('last', int64),
+               ('start', float64), ('end', float64), ('duration', float64),
+               ('x', float64), ('y', float64)]
+
+
+def to_degrees(x, y, screen_size, distance):
+    """
+    Gazepoint POG (fractions of the screen) to visual angles from the center of the screen.
+    :param screen_size: width and height of the screen in cm
+    :param distance: distance from eyes to the screen in cm
+    """
+    return (degrees(arctan((x - 0.5) * screen_size[0] / distance)),
+            degrees(arctan((y - 0.5) * screen_size[1] / distance)))
+
+
+def _runs(labels):
+    """
+    :return: first and last indices of runs of equal labels
+    """
+    if not len(labels):
+        return empty(0, dtype=int64), empty(0, dtype=int64)
+    firsts = concatenate([[0], flatnonzero(labels[1:] != labels[:-1]) + 1])
+    lasts = concatenate([firsts[1:] - 1, [len(labels) - 1]])
+    return firsts, lasts
+
+
+def _candidates(samples, screen_size, distance, velocity_threshold, acceleration_threshold, x, y, valid):
+    """
+    SACCADE for valid samples with velocity or acceleration over thresholds, FIXATION for other valid samples,
+    BLINK for invalid ones. A candidate depends only on the sample and two samples before it.
+    """
+    time = samples['TIME'].astype(float64)
+    x_degrees, y_degrees = to_degrees(samples[x].astype(float64), samples[y].astype(float64), screen_size, distance)
+    valid = (samples[valid] == 1) & isfinite(x_degrees) & isfinite(y_degrees)
+
+    # velocity and acceleration of a sample are taken from the previous one, zero if one of them is invalid
+    dt = diff(time)
+    dt[dt <= 0] = nan
+    velocity = zeros(len(time))
+    velocity[1:] = hypot(diff(x_degrees), diff(y_degrees)) / dt
+    velocity[1:][~(valid[1:] & valid[:-1])] = 0
+    velocity[~isfinite(velocity)] = 0
+    acceleration = zeros(len(time))
+    acceleration[1:] = absolute(diff(velocity)) / dt
+    acceleration[~isfinite(acceleration)] = 0
+
+    candidates = full(len(time), BLINK, dtype=int8)
+    candidates[valid] = FIXATION
+    candidates[valid & ((velocity > velocity_threshold) | (acceleration > acceleration_threshold))] = SACCADE
+    return candidates
+
+
+def _label_runs(candidates, time, fixation_duration, blink_duration):
+    """
+    Runs of fixation and blink candidates shorter than their durations are NONE.
+    """
+    firsts, lasts = _runs(candidates)
+    durations = time[lasts] - time[firsts]
+    labels = candidates[firsts]
+    labels[((labels == FIXATION) & (durations < fixation_duration)) |
+           ((labels == BLINK) & (durations < blink_duration))] = NONE
+    return repeat(labels, lasts - firsts + 1)
+
+
+def label_samples(samples, screen_size=(39.9, 29.9), distance=57., velocity_threshold=35.,
+                  acceleration_threshold=9500., fixation_duration=0.1, blink_duration=0.15,
+                  x='FPOGX', y='FPOGY', valid='FPOGV'):
+    """
+    Labels Gazepoint samples as fixations, saccades and blinks at once for the whole array.
+
+    A valid sample is a saccade if angular velocity or acceleration of gaze exceeds its threshold (I-VT with
+    acceleration as in PyGaze). Runs of other valid samples lasting at least `fixation_duration` are fixations,
+    runs of invalid samples lasting at least `blink_duration` are blinks, the rest is NONE.
+
+    :param samples: structured array with TIME (seconds), `x`, `y` and `valid` fields,
+        e.g. of OpenGazeTrackerRETTNA.sample or GazeLog
+    :param screen_size: width and height of the screen in cm
+    :param distance: distance from eyes to the screen in cm
+    :param velocity_threshold: degrees per second
+    :param acceleration_threshold: degrees per second ** 2
+    :param fixation_duration: seconds
+    :param blink_duration: seconds
+    :return: int8 labels of samples
+    """
+    candidates = _candidates(samples, screen_size, distance, velocity_threshold, acceleration_threshold, x, y, valid)
+    return _label_runs(candidates, samples['TIME'].astype(float64), fixation_duration, blink_duration)
+
+
+def label_events(samples, labels, x='FPOGX', y='FPOGY'):
+    """
+    :return: array of EVENT_DTYPE with runs of equal labels except NONE; `x` and `y` are mean POG of fixations
+    """
+    firsts, lasts = _runs(labels)
+    kinds = labels[firsts]
+    events = empty(len(firsts), dtype=EVENT_DTYPE)
+    events['type'], events['first'], events['last'] = kinds, firsts, lasts
+    time = samples['TIME']
+    events['start'], events['end'] = time[firsts], time[lasts]
+    events['duration'] = events['end'] - events['start']
+    if len(firsts):
+        counts = lasts - firsts + 1
+        events['x'] = add.reduceat(samples[x].astype(float64), firsts) / counts
+        events['y'] = add.reduceat(samples[y].astype(float64), firsts) / counts
+        events['x'][kinds != FIXATION] = nan
+        events['y'][kinds != FIXATION] = nan
+    return events[kinds != NONE]
+
+
+def detect_events(samples, **kwargs):
+    """
+    Fixations, saccades and blinks of Gazepoint samples, see `label_samples` for arguments.
+
+    Examples
+    --------
+
+    >>> log = GazeLog('log/log.tsv')
+    >>> events = detect_events(log.data)
+    >>> fixations = events[events['type'] == FIXATION]
+    """
+    labels = label_samples(samples, **kwargs)
+    point = {key: kwargs[key] for key in ['x', 'y'] if key in kwargs}
+    return label_events(samples, labels, **point)
+
+
+class GazeEventDetector:
+    """
+    Incremental `detect_events` for live samples.
+
+    Samples of the last run are kept until it ends (with two samples before it for velocity and acceleration),
+    so returned events are the same as of `detect_events` of the whole stream.
+
+    Examples
+    --------
+
+    >>> detector = GazeEventDetector.from_tracker(tracker)
+    >>> while recording:
+    >>>     for event in detector.update(tracker.sample()):
+    >>>         ...
+    """
+
+    def __init__(self, screen_size=(39.9, 29.9), distance=57., velocity_threshold=35., acceleration_threshold=9500.,
+                 fixation_duration=0.1, blink_duration=0.15, x='FPOGX', y='FPOGY', valid='FPOGV'):
+        """
+        See `label_samples`.
+        """
+        self.candidate_params = (screen_size, distance, velocity_threshold, acceleration_threshold, x, y, valid)
+        self.fixation_duration = fixation_duration
+        self.blink_duration = blink_duration
+        self.x, self.y = x, y
+
+        self.samples = None
+        # index of the first kept sample in the stream, number of kept samples before the last run
+        self.offset = 0
+        self.context = 0
+
+    @classmethod
+    def from_tracker(cls, tracker, distance=57.):
+        """
+        Thresholds of OpenGazeTrackerRETTNA.
+        """
+        return cls(screen_size=tracker.screensize, distance=distance,
+                   velocity_threshold=tracker.spdtresh, acceleration_threshold=tracker.accthresh,
+                   fixation_duration=tracker.fixtimetresh / 1000., blink_duration=tracker.blinkthresh / 1000.)
+
+    def update(self, samples):
+        """
+        :param samples: new samples, oldest first, or None
+        :return: events of EVENT_DTYPE which ended, `first` and `last` are indices in the stream
+        """
+        if samples is None or not len(samples):
+            return empty(0, dtype=EVENT_DTYPE)
+        self.samples = samples if self.samples is None else concatenate([self.samples, samples])
+
+        candidates = _candidates(self.samples, *self.candidate_params)[self.context:]
+        run_samples = self.samples[self.context:]
+        # the last run may continue
+        finished = _runs(candidates)[0][-1]
+        time = run_samples['TIME'][:finished].astype(float64)
+        labels = _label_runs(candidates[:finished], time, self.fixation_duration, self.blink_duration)
+        events = label_events(run_samples[:finished], labels, x=self.x, y=self.y)
+        events['first'] += self.offset + self.context
+        events['last'] += self.offset + self.context
+
+        start = self.context + finished
+        keep = max(start - 2, 0)
+        self.samples = self.samples[keep:]
+        self.offset += keep
+        self.context = start - keep
+        return events
+
+    def flush(self):
+        """
+        :return: events of the last run, e.g. when recording stops
+        """
+        if self.samples is None:
+            return empty(0, dtype=EVENT_DTYPE)
+        run_samples = self.samples[self.context:]
+        candidates = _candidates(self.samples, *self.candidate_params)[self.context:]
+        labels = _label_runs(candidates, run_samples['TIME'].astype(float64), self.fixation_duration,
+                             self.blink_duration)
+        events = label_events(run_samples, labels, x=self.x, y=self.y)
+        events['first'] += self.offset + self.context
+        events['last'] += self.offset + self.context
+        self.samples = None
+        self.offset += self.context + len(run_samples)
+        self.context = 0
+        return events
@@ -1,4 +1,3 @@
-import copy
 from pygaze.settings import settings
 settings.DISPSIZE = (200, 200)
 settings.DISPTYPE = 'pygame'
@@ -21,12 +20,188 @@ from pygaze.settings import settings
 import socket
 import time
 
+from numpy import dtype
+from numpy import empty
+from numpy import concatenate
+from numpy import searchsorted
+from numpy import isfinite
+from numpy import diff
+from numpy import flatnonzero
+from numpy import inf
+
 try:
     from pygaze._misc.misc import copy_docstr
 except:
     pass
 
 
+class SampleRing:
+    """
+    Preallocated ring buffer of numeric REC samples of the OpenGaze server.
+
+    There is one producer (the incoming thread) and one consumer (the thread calling `read`), so no lock is needed:
+    the producer fills a row and only then moves the write counter, the consumer copies rows up to the counter.
+    If the consumer is late by more than `capacity` samples, the oldest samples are lost.
+    """
+
+    fields = ['TIME', 'CNT', 'FPOGX', 'FPOGY', 'FPOGV', 'LPOGX', 'LPOGY', 'LPOGV', 'RPOGX', 'RPOGY', 'RPOGV']
+    dtype = dtype([('t', 'f8')] + [(field, 'f8') for field in fields])
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.buffer = empty(capacity, dtype=self.dtype)
+        self._written = 0
+        self._read = 0
+
+    def __len__(self):
+        return min(self._written - self._read, self.capacity)
+
+    def push(self, t, msgdict):
+        """
+        Appends REC message parsed by OpenGaze, missing fields are nan.
+        """
+        self.buffer[self._written % self.capacity] = (t, *(float(msgdict.get(field, 'nan')) for field in self.fields))
+        self._written += 1
+
+    def read(self):
+        """
+        Samples which came after the previous read, oldest first.
+        :return: structured array with fields `t` (time.monotonic of receiving) and `fields`
+        """
+        written = self._written
+        start = max(self._read, written - self.capacity)
+        self._read = written
+        first, last = start % self.capacity, written % self.capacity
+        if written - start == 0:
+            return self.buffer[:0].copy()
+        if first < last:
+            return self.buffer[first:last].copy()
+        return concatenate([self.buffer[first:], self.buffer[:last]])
+
+    def clear(self):
+        self._read = self._written
+
+
+class GazeAligner:
+    """
+    Finds gaze at a moment of time.monotonic, e.g. at a moment of grabbing a camera frame.
+
+    Samples are timestamped by the tracker clock (TIME), which is mapped to time.monotonic with offset
+    min(receive time - TIME): the least delayed sample gives the best offset, and samples received
+    in one packet keep their own times. When TIME goes back (the tracker restarted its clock, e.g. after
+    recalibration or reconnection), kept samples and the offset are dropped. Samples without TIME are skipped.
+
+    Samples come in order of TIME, so they are appended to a buffer and old ones are cut from its front.
+    Gaze is linearly interpolated between two valid neighbour samples, found by binary search.
+
+    Examples
+    --------
+
+    >>> aligner = GazeAligner()
+    >>> aligner.extend(tracker.sample())
+    >>> if frame_time <= aligner.latest_time():
+    >>>     gaze = aligner.gaze_at(frame_time)
+    """
+
+    def __init__(self, window=2.0, max_gap=0.05, capacity=1024):
+        """
+        :param window: seconds of samples to keep
+        :param max_gap: maximal time between neighbour samples to interpolate between them
+        :param capacity: initial size of the buffer, it grows when `window` needs more samples
+        """
+        self.window = window
+        self.max_gap = max_gap
+        # kept samples are rows start:end of the buffer
+        self._samples = empty(capacity, dtype=SampleRing.dtype)
+        self._times = empty(capacity)
+        self._start = 0
+        self._end = 0
+        self.offset = inf
+        # TIME of the last sample
+        self.tracker_time = -inf
+
+    @property
+    def samples(self):
+        return self._samples[self._start:self._end]
+
+    @property
+    def times(self):
+        return self._times[self._start:self._end]
+
+    def reset(self):
+        self._start = self._end = 0
+        self.offset = inf
+        self.tracker_time = -inf
+
+    def extend(self, samples):
+        if samples is None or not len(samples):
+            return
+        samples = samples[isfinite(samples['TIME'])]
+        if not len(samples):
+            return
+        tracker_times = samples['TIME']
+        restarts = flatnonzero(diff(concatenate([[self.tracker_time], tracker_times])) < 0)
+        if len(restarts):
+            self.reset()
+            samples, tracker_times = samples[restarts[-1]:], tracker_times[restarts[-1]:]
+        self.tracker_time = tracker_times[-1]
+
+        offset = (samples['t'] - tracker_times).min()
+        if offset < self.offset:
+            # kept samples are moved by the better offset, their order stays
+            if self._end > self._start:
+                self._times[self._start:self._end] += offset - self.offset
+            self.offset = offset
+        self._append(samples, tracker_times + self.offset)
+
+        # keep samples of the last `window` seconds
+        self._start += searchsorted(self.times, self._times[self._end - 1] - self.window, side='right')
+
+    def _append(self, samples, times):
+        count, kept = len(samples), self._end - self._start
+        if self._end + count > len(self._samples):
+            # kept samples are moved to the front, the buffer grows if they fill its half
+            if 2 * (kept + count) > len(self._samples):
+                capacity = 2 * (kept + count)
+                self._samples = concatenate([self.samples, empty(capacity - kept, dtype=self._samples.dtype)])
+                self._times = concatenate([self.times, empty(capacity - kept)])
+            else:
+                self._samples[:kept] = self.samples
+                self._times[:kept] = self.times
+            self._start, self._end = 0, kept
+        self._samples[self._end:self._end + count] = samples
+        self._times[self._end:self._end + count] = times
+        self._end += count
+
+    def latest_time(self):
+        return self.times[-1] if len(self.times) else -inf
+
+    def gaze_at(self, t):
+        """
+        :return: dict of gaze points of eyes, time of the nearest sample; None and None if there are no
+            valid samples around `t`
+        """
+        i = searchsorted(self.times, t)
+        if i == 0 or i == len(self.times):
+            return None, None
+        before, after = self.samples[i - 1], self.samples[i]
+        time_before, time_after = self.times[i - 1], self.times[i]
+        if time_after - time_before > self.max_gap or not (before['FPOGV'] > 0 and after['FPOGV'] > 0):
+            return None, None
+
+        weight = (t - time_before) / (time_after - time_before) if time_after > time_before else 0.
+
+        def interpolate(field):
+            return float(before[field] + weight * (after[field] - before[field]))
+
+        # image of Basler camera is flipped, so eyes are swapped
+        gaze = {
+            'right': (interpolate('LPOGX'), interpolate('LPOGY')),
+            'left': (interpolate('RPOGX'), interpolate('RPOGY'))
+        }
+        return gaze, time_before if weight < 0.5 else time_after
+
+
 class OpenGazeTrackerRETTNA(OpenGazeTracker):
 
     def __init__(self, display, logfile='log/log', \
@@ -109,34 +284,28 @@ class OpenGazeTrackerRETTNA(OpenGazeTracker):
         self._elog("pygaze initiation report end")
 
     def sample(self):
-        # Get newest sample.
-        tracker = self.opengaze
-
-        # If there is no current record yet, return None.
-        tracker._inlock.acquire()
-
-        if len(tracker._incoming_queue) == 0:
-            frames = None
-        else:
-            frames = copy.deepcopy(tracker._incoming_queue)
-            tracker._incoming_queue = []
-
-        tracker._inlock.release()
-
-        return frames
+        """
+        Samples received after the previous call, oldest first.
+        :return: structured array of SampleRing.dtype, or None if there are no new samples
+        """
+        samples = self.opengaze.samples.read()
+        return samples if len(samples) else None
 
     def start_recording(self):
         super().start_recording()
-        self.opengaze._incoming_queue = []
+        self.opengaze.samples.clear()
 
 
 class OpenGazeRETNNA(OpenGaze):
 
+    def __init__(self, *args, capacity=1024, **kwargs):
+        # the incoming thread is started by OpenGaze.__init__
+        self.samples = SampleRing(capacity)
+        super().__init__(*args, **kwargs)
 
     def _process_incoming(self):
 
         self._debug_print("Incoming Thread started.")
-        self._incoming_queue = []
 
         while self._connected.is_set():
 
@@ -149,8 +318,9 @@ class OpenGazeRETNNA(OpenGaze):
                 instring = self._sock.recv(self._maxrecvsize)
             except socket.timeout:
                 timeout = True
-            # Get a received timestamp.
+            # Get a received timestamp, and one on the clock of camera frames.
             t = time.time()
+            t_monotonic = time.monotonic()
             # Unlock the socket again.
             self._socklock.release()
 
@@ -168,7 +338,7 @@ class OpenGazeRETNNA(OpenGaze):
             if self._unfinished:
                 # Combine the currently unfinished message and the
                 # most recent incoming message.
-                messages[0] = copy.copy(self._unfinished) + messages[0]
+                messages[0] = self._unfinished + messages[0]
                 # Reset the unfinished message.
                 self._unfinished = ''
             # Check if the last message was actually complete.
@@ -190,8 +360,11 @@ class OpenGazeRETNNA(OpenGaze):
                 # properly received.
                 if command == 'ACK':
                     self._acklock.acquire()
-                    self._acknowledgements[msgdict['ID']] = copy.copy(t)
+                    self._acknowledgements[msgdict['ID']] = t
                     self._acklock.release()
+                # Numeric samples go to the ring buffer, it needs no lock.
+                if command == 'REC':
+                    self.samples.push(t_monotonic, msgdict)
                 # Acquire the Lock for the incoming dict, so that it
                 # won't be accessed at the same time.
                 self._inlock.acquire()
@@ -206,22 +379,14 @@ class OpenGazeRETNNA(OpenGaze):
                 if msgdict['ID'] not in self._incoming[command].keys():
                     self._incoming[command][msgdict['ID']] = {}
                 # Add receiving time stamp, and the values for each
-                # parameter to the current dict.
-                self._incoming[command][msgdict['ID']]['t'] = \
-                    copy.copy(t)
-                for par, val in msgdict.items():
-                    self._incoming[command][msgdict['ID']][par] = \
-                        copy.copy(val)
+                # parameter to the current dict, values are immutable strings.
+                self._incoming[command][msgdict['ID']]['t'] = t
+                self._incoming[command][msgdict['ID']].update(msgdict)
                 # Log sample if command=='REC' and when the logging
                 # event is set.
                 if command == 'REC' and self._logging.is_set():
-                    self._logqueue.put(copy.deepcopy(self._incoming[command][msgdict['ID']]))
+                    self._logqueue.put(dict(self._incoming[command][msgdict['ID']]))
                 # Unlock the incoming dict again.
-
-                #Filling queue
-                if 'REC' in self._incoming.keys() and 'NO_ID' in self._incoming['REC'].keys():
-                    self._incoming_queue.append(self._incoming['REC']['NO_ID'])
-
                 self._inlock.release()
 
         self._debug_print("Incoming Thread ended.")
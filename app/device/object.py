@@ -2,11 +2,18 @@ from numpy import array
 from numpy import hstack
 from numpy import vstack
 from numpy import zeros
+from numpy import ascontiguousarray
 from cv2 import Rodrigues
-from numpy.linalg import inv
 
 
 class SceneObj:
+    """
+    Object of the scene with extrinsic parameters relative to its origin.
+
+    Rotation matrix, its transpose and extrinsic matrices are computed once and cached,
+    the cache is dropped when `rotation` or `translation` is assigned.
+    Cached matrices are read-only, copy them before changing.
+    """
 
     to_m = {
         'mm': 1000
@@ -15,6 +22,7 @@ class SceneObj:
     def __init__(self, name, origin, extrinsic_matrix=None, scale='mm'):
         self.name = name
         self.origin = origin
+        self._cache = {}
         if extrinsic_matrix is None:
             self.translation = zeros((3, 1))
             self.rotation = zeros((3, 1))
@@ -23,24 +31,74 @@ class SceneObj:
             self.translation = (extrinsic_matrix[:3, 3] / self.to_m[scale]).reshape(3, 1)
             self.rotation = (Rodrigues(extrinsic_matrix[:3, :3])[0]).reshape(3, 1)
 
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, value):
+        self._rotation = value
+        self._cache = {}
+
+    @property
+    def translation(self):
+        return self._translation
+
+    @translation.setter
+    def translation(self, value):
+        self._translation = value
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            value = compute()
+            value.flags.writeable = False
+            self._cache[key] = value
+        return self._cache[key]
+
     def get_rotation_matrix(self):
-        return Rodrigues(self.rotation)[0]
+        return self._cached('rotation_matrix', lambda: Rodrigues(array(self.rotation, dtype=float))[0])
+
+    def get_inverse_rotation_matrix(self):
+        # rotation matrix is orthogonal, its inverse is its transpose
+        return self._cached('inverse_rotation_matrix', lambda: ascontiguousarray(self.get_rotation_matrix().T))
+
+    def get_inverse_translation(self):
+        """
+        Translation of the origin in space of the object: -R^T @ t.
+        """
+        return self._cached('inverse_translation',
+                            lambda: -self.get_inverse_rotation_matrix() @ array(self.translation,
+                                                                                dtype=float).reshape(3, 1))
 
     def to_dict(self):
         return {'rotation': self.rotation.tolist(), 'translation': self.translation.tolist()}
 
     def restore_extrinsic_matrix(self):
-        return vstack(
+        return self._cached('extrinsic_matrix', lambda: vstack(
             (
                 hstack(
                     (
-                        Rodrigues(self.rotation)[0],
-                        self.translation.reshape(3, 1)
+                        self.get_rotation_matrix(),
+                        array(self.translation, dtype=float).reshape(3, 1)
                     )
                 ),
                 array([0.0, 0.0, 0.0, 1.0])
             )
-        )
+        ))
+
+    def restore_inverse_extrinsic_matrix(self):
+        return self._cached('inverse_extrinsic_matrix', lambda: vstack(
+            (
+                hstack(
+                    (
+                        self.get_inverse_rotation_matrix(),
+                        self.get_inverse_translation()
+                    )
+                ),
+                array([0.0, 0.0, 0.0, 1.0])
+            )
+        ))
 
     # def set_extrinsic_from_matrix(self, matrix, scale='mm'):
     #     matrix = array(matrix)
@@ -49,8 +107,7 @@ class SceneObj:
     #     return self
 
     def vectors_to_self(self, vectors):
-        return inv(self.get_rotation_matrix()) @ (vectors.reshape(3, -1) - self.translation.reshape(3, 1))
+        return self.get_inverse_rotation_matrix() @ (vectors.reshape(3, -1) - self.translation.reshape(3, 1))
 
     def vectors_to_origin(self, vectors):
         return self.get_rotation_matrix() @ vectors.reshape(3, -1) + self.translation.reshape(3, 1)
-
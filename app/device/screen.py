@@ -1,10 +1,13 @@
 from .object import SceneObj
 from numpy import array
+from numpy import append
+from numpy import asarray
+from numpy import column_stack
+from numpy import errstate
 from numpy import sqrt
 from numpy import cross, dot
 from numpy import zeros
 from numpy import uint8
-from numpy.linalg import solve
 from cv2 import copyMakeBorder, BORDER_CONSTANT
 from app.frame import Frame
 
@@ -12,16 +15,15 @@ from app.frame import Frame
 def plane_line_intersection(line_points, plane_points):
 
     """
-    Compute intersection point of plane and lineself.
-    Parameter line_points consists of two points and stands to determine
-    line's equesion:
-        (x - x_1)/(x_2 - x_1) =
-       =(y - y_1)/(y_2 - y_1) =
-       =(z - z_1)/(z_2 - z_1).
+    Compute intersection point of plane and line.
+    Parameter line_points consists of two points of the line.
     Parameter plane_points consists of three points and stands to determine
     plane's equasion:
         A*x + B*y + C*z = D.
-    This function returns 3D coordinates of intersection point.
+    Intersection is point_2 + t * (point_1 - point_2), where
+        t = (D - (A, B, C) @ point_2) / ((A, B, C) @ (point_1 - point_2)).
+    This function returns 3D coordinates of intersection point,
+    or nan/inf if the line is parallel to the plane.
     """
 
     line_point_1 = array(line_points[0]).reshape(3)
@@ -30,35 +32,24 @@ def plane_line_intersection(line_points, plane_points):
     plane_point_2 = array(plane_points[1]).reshape(3)
     plane_point_3 = array(plane_points[2]).reshape(3)
 
-    # These two vectors are in the plane.
-    vector_1 = plane_point_3 - plane_point_1
-    vector_2 = plane_point_2 - plane_point_1
-
-    # The cross prodaction is a normal vector to the plane.
-    cross_product = cross(vector_1, vector_2)
-    a, b, c = cross_product
-    d = dot(cross_product, plane_point_3)
-
-    # Compute the solution of equasion A*x = B.
-    # Compute matrix A.
-    A11 = 1 / (line_point_2[0] - line_point_1[0])
-    A12 = -1 / (line_point_2[1] - line_point_1[1])
-    A13 = 0
-    A21 = 0
-    A22 = 1 / (line_point_2[1] - line_point_1[1])
-    A23 = -1 / (line_point_2[2] - line_point_1[2])
-    A31, A32, A33 = a, b, c
-    A = array([[A11, A12, A13],
-                  [A21, A22, A23],
-                  [A31, A32, A33]])
-
-    # Compute vector B.
-    B1 = line_point_1[0] * A11 + line_point_1[1] * A12
-    B2 = line_point_1[1] * A22 + line_point_1[2] * A23
-    B3 = d
-    B = array([B1, B2, B3])
-    # Compute intersection point.
-    return solve(A, B)
+    # The cross prodaction of two vectors in the plane is a normal vector to the plane.
+    normal = cross(plane_point_3 - plane_point_1, plane_point_2 - plane_point_1)
+    return line_plane_intersections(line_point_1, line_point_2, normal, dot(normal, plane_point_3))[0]
+
+
+def line_plane_intersections(line_starts, line_ends, normal, offset):
+    """
+    Intersection points of N lines, given by two points each, with plane normal @ x = offset.
+    :param line_starts: array Nx3
+    :param line_ends: array Nx3
+    :return: array Nx3, nan/inf for lines parallel to the plane
+    """
+    line_starts = asarray(line_starts, dtype=float).reshape(-1, 3)
+    line_ends = asarray(line_ends, dtype=float).reshape(-1, 3)
+    directions = line_starts - line_ends
+    with errstate(divide='ignore', invalid='ignore'):
+        t = (offset - line_ends @ normal) / (directions @ normal)
+    return line_ends + t[:, None] * directions
 
 
 class Screen(SceneObj):
@@ -92,15 +83,41 @@ class Screen(SceneObj):
         point = array([coord*axis*self.mpp for coord, axis in zip((y, x), self.resolution)]+[0.0]).reshape((3, 1))
         return self.vectors_to_origin(point)
 
+    def get_plane(self):
+        """
+        Plane of the screen in origin space: normal @ x = offset.
+        :return: normal, offset
+        """
+        # screen lies in xy-plane of its own space, plane is cached as (A, B, C, D)
+        plane = self._cached('plane', lambda: append(self.get_rotation_matrix()[:, 2],
+                                                     dot(self.get_rotation_matrix()[:, 2],
+                                                         self.translation.reshape(3))))
+        return plane[:3], plane[3]
+
     def get_intersection_point_in_pixels(self, line_points_origin):
-        intersection_origin = self.get_intersection_point_origin(line_points_origin)
-        intersection_self = self.vectors_to_self(intersection_origin).reshape(3)
-        return (intersection_self[1]/self.mpp, intersection_self[0]/self.mpp)
+        intersection = self.get_intersection_points_in_pixels(line_points_origin[0], line_points_origin[1])[0]
+        return (intersection[0], intersection[1])
 
     def get_intersection_point_origin(self, line_points_origin):
-        wall_points_origin = array([self.point_to_origin(0, 0), self.point_to_origin(1, 1), self.point_to_origin(1, 0)])
-        intersection_origin = plane_line_intersection(line_points_origin, wall_points_origin)
-        return intersection_origin
+        return self.get_intersection_points_origin(line_points_origin[0], line_points_origin[1])[0]
+
+    def get_intersection_points_origin(self, line_starts, line_ends):
+        """
+        Intersection points of N lines with the screen in origin space.
+        :param line_starts: array Nx3, e.g. eye centers + gaze vectors
+        :param line_ends: array Nx3, e.g. eye centers
+        :return: array Nx3
+        """
+        return line_plane_intersections(line_starts, line_ends, *self.get_plane())
+
+    def get_intersection_points_in_pixels(self, line_starts, line_ends):
+        """
+        Intersection points of N lines with the screen in pixels.
+        :return: array Nx2
+        """
+        intersections_self = (self.get_intersection_points_origin(line_starts, line_ends) -
+                              self.translation.reshape(1, 3)) @ self.get_rotation_matrix()
+        return column_stack((intersections_self[:, 1] / self.mpp, intersections_self[:, 0] / self.mpp))
 
     def generate_image_with_circles(self, points, padding=10, labels=None, colors=None, image=None):
         if image is None:
@@ -0,0 +1,173 @@
+from app import SessionReader
+from app.meta import MetaWriter
+from app.meta import to_xyz_dict
+from app.estimation import load_gaze_model
+import numpy as np
+import os
+from queue import Queue
+from threading import Thread
+from threading import Event
+
+
+# BRS.GazeEstimation (cam_100) flips x and y of the origin camera, see SessionReader.load_json_data
+CAM_100_FLIP = np.array([-1, -1, 1])
+# eyes of extract_eyes_from_person images (left, right) for the model, as in training and visualize_predict
+MODEL_EYES = ['left', 'right']
+
+
+def to_xy_dict(point):
+    return {axis: value for axis, value in zip(['X', 'Y'], point)}
+
+
+def snapshot_id(snapshot, position):
+    return int(snapshot) if snapshot.isdigit() else position
+
+
+def prepare_batches(batches, face_detector, scene, processes, queue, stop):
+    """
+    Stage of a thread: detects persons of batches of snapshots in worker processes and extracts their eyes.
+    Puts tuple(list of (snapshot, person), eye images 2N x 72 x 120, head poses 2N x 3) for each batch,
+    None at the end, or an exception. Stops before the next batch when `stop` is set.
+    """
+    camera = scene.cams['basler']
+    try:
+        for batch in batches:
+            if stop.is_set():
+                break
+            persons_batch = face_detector.detect_persons_batch([frames['basler'] for (frames, _), _ in batch],
+                                                               scene.origin, processes=processes)
+            eyes = np.empty((2 * len(batch), 72, 120), dtype=np.uint8)
+            poses = np.empty((2 * len(batch), 3))
+            items = []
+            for ((frames, _), snapshot), persons in zip(batch, persons_batch):
+                if not persons:
+                    continue
+                person, i = persons[0], 2 * len(items)
+                frames['basler'].extract_eyes_from_person(person, resolution=(120, 72), equalize_hist=True,
+                                                          to_grayscale=True, remove_specularity=True,
+                                                          out=eyes[i:i + 2])
+                poses[i:i + 2] = person.get_norm_rotation(camera).reshape(1, 3)
+                items.append((snapshot, person))
+            queue.put((items, eyes[:2 * len(items)], poses[:2 * len(items)]))
+        queue.put(None)
+    except BaseException as error:
+        queue.put(error)
+
+
+def estimate_batch(items, eyes, poses, model, scene, wall):
+    """
+    Gazes of persons of a batch in one forward pass and their intersections with the wall.
+    :return: rows of result for MetaWriter, coordinates are in cam_100 space, wall points in pixels
+    """
+    if not items:
+        return []
+    gazes = model.estimate_gazes(eyes, poses, eyes=MODEL_EYES * len(items))
+    gazes = (scene.cams['basler'].get_rotation_matrix() @ gazes.T).T.reshape(-1, 2, 3)
+    gazes = {'left': gazes[:, 0], 'right': gazes[:, 1]}
+    centers = {eye: np.array([person.get_eye_center(eye).reshape(3) for _, person in items])
+               for eye in ['left', 'right']}
+    common = gazes['left'] + gazes['right']
+    common /= np.linalg.norm(common, axis=1, keepdims=True)
+    common_centers = (centers['left'] + centers['right']) / 2
+
+    # left, right and common gazes of all persons in one pass
+    intersections = wall.get_intersection_points_in_pixels(
+        np.concatenate([centers['left'] + gazes['left'], centers['right'] + gazes['right'], common_centers + common]),
+        np.concatenate([centers['left'], centers['right'], common_centers])
+    ).reshape(3, len(items), 2)
+
+    rows = []
+    for i, (snapshot, person) in enumerate(items):
+        rows.append({
+            'snapshot': snapshot,
+            'gazeLeft': to_xyz_dict(gazes['left'][i] * CAM_100_FLIP),
+            'gazeRight': to_xyz_dict(gazes['right'][i] * CAM_100_FLIP),
+            'gazeCommon': to_xyz_dict(common[i] * CAM_100_FLIP),
+            'eyeSphereCenterLeft': to_xyz_dict(centers['left'][i] * CAM_100_FLIP),
+            'eyeSphereCenterRight': to_xyz_dict(centers['right'][i] * CAM_100_FLIP),
+            'faceGaze': to_xyz_dict(person.get_face_gaze().reshape(3) * CAM_100_FLIP),
+            'nosePoint': to_xyz_dict(person.get_nose().reshape(3) * CAM_100_FLIP),
+            'wallLeft': to_xy_dict(intersections[0, i]),
+            'wallRight': to_xy_dict(intersections[1, i]),
+            'wallCommon': to_xy_dict(intersections[2, i])
+        })
+    return rows
+
+
+def estimate_session(session_path, output_path, face_detector, scene, model, prefetch=8, batch_size=64,
+                     processes=None, queue_size=4, file_name='estimated_gazes.csv'):
+    """
+    Estimates gazes of the first person of each basler frame of the session, writes them to csv.
+
+    Stages are pipelined: snapshots are read by `prefetch` threads, persons of a batch are detected in `processes`
+    worker processes and eyes are extracted in a thread, while the previous batch is estimated and written.
+    :return: number of written rows
+    """
+    session_code = os.path.split(session_path)[-1]
+    parser = SessionReader()
+    parser.fit(session_code, session_path, scene.cams, by='basler')
+    # only frames are read, json data of devices is not used
+    parser.data_dirs = {}
+    os.makedirs(os.path.join(output_path, session_code), exist_ok=True)
+
+    face_detector.reset()
+    snapshots = parser.batches_iterate(batch_size, progress_bar=True, prefetch=prefetch, cam_names=['basler'])
+    batches = ([((frames, data), snapshot_id(snapshot, position)) for position, ((frames, data), snapshot)
+                in enumerate(batch, start=index * batch_size)] for index, batch in enumerate(snapshots))
+
+    # batches wait in a bounded queue, so reading and detection do not run far ahead of estimation
+    queue = Queue(maxsize=queue_size)
+    stop = Event()
+    producer = Thread(target=prepare_batches, args=(batches, face_detector, scene, processes, queue, stop),
+                      daemon=True)
+    producer.start()
+
+    written = 0
+    wall = scene.screens['wall']
+    try:
+        with MetaWriter(os.path.join(output_path, session_code, file_name)) as writer:
+            for prepared in iter(queue.get, None):
+                if isinstance(prepared, BaseException):
+                    raise prepared
+                for row in estimate_batch(*prepared, model=model, scene=scene, wall=wall):
+                    writer.write(row)
+                    written += 1
+    finally:
+        # unblock the producer if estimation failed
+        stop.set()
+        while producer.is_alive():
+            if not queue.empty():
+                queue.get()
+            producer.join(timeout=0.1)
+        # reading threads of the parser are stopped
+        snapshots.close()
+        parser.close()
+    return written
+
+
+def estimate(face_detector, scene, dataset_path, path_to_model, output_path=None, prefetch=8, batch_size=64,
+             processes=0, queue_size=4, *args, **kwargs):
+    """
+    Offline gaze estimation of each session of the dataset, results are written to
+    <output_path>/<session>/estimated_gazes.csv with columns of cam_100 gazes and wall points in pixels.
+    Persons are detected in `processes` worker processes, 0 - number of cores.
+    """
+    if not output_path:
+        output_path = dataset_path
+
+    # workers are forked before the model is loaded and threads are started
+    processes = face_detector.open_pool(int(processes) or None)
+    model = load_gaze_model(path_to_model)
+    prefetch, batch_size, queue_size = int(prefetch), int(batch_size), int(queue_size)
+
+    try:
+        for session in sorted(os.listdir(dataset_path)):
+            session_path = os.path.join(dataset_path, session)
+            if not os.path.isdir(os.path.join(session_path, 'DataSource')):
+                continue
+            written = estimate_session(session_path, output_path, face_detector, scene, model, prefetch=prefetch,
+                                       batch_size=batch_size, processes=processes, queue_size=queue_size)
+            print(f'Gazes of session {session}: {written} snapshots')
+    finally:
+        # worker processes are stopped even if a session fails
+        face_detector.close()
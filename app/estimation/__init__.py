@@ -1,4 +1,14 @@
 from .persondetector import PersonDetector
-from .gazenet import GazeNet, angle_accuracy
+from .gazenet import GazeNet
+from .npnet import NumpyGazeNet
 from .parser import DatasetParser
+from .store import EyePatchStore
 
+
+def load_gaze_model(path_to_model):
+    """
+    GazeNet of .h5 model, or NumpyGazeNet of .npz weights exported by npnet.export_weights (runs without tensorflow).
+    """
+    if path_to_model.endswith('.npz'):
+        return NumpyGazeNet().init(path_to_model)
+    return GazeNet().init(path_to_model)
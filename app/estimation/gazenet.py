@@ -1,11 +1,10 @@
-from keras.models import load_model
 from .transform import gaze2Dto3D
 from .transform import gaze3Dto2D
 from .transform import pose3Dto2D
-from .nn import angle_accuracy
-from .nn import create_model
-from .nn import create_callbacks
 from numpy import reshape
+from numpy import array
+from numpy import asarray
+from numpy import where
 import os
 
 
@@ -45,16 +44,30 @@ def postprocess(predicted_gaze_tensor):
 
 class GazeNet:
 
+    __FLIP = array([-1, 1, 1])
+
     def __init__(self):
         self.model = None
 
     def init(self, path_to_model):
+        # keras is imported on demand, so inference with NumpyGazeNet does not need it
+        from keras.models import load_model
+        from .nn import angle_accuracy
+
         self.model = load_model(path_to_model,
                                 custom_objects={'angle_accuracy': angle_accuracy},
                                 compile=True)
         return self
 
-    def train(self, path_to_save, create_new=False, create_dict=None, sess_name=None, save_period=100, **kwargs):
+    def train(self, path_to_save, create_new=False, create_dict=None, sess_name=None, save_period=100, generator=None,
+              **kwargs):
+        """
+        Train model on arrays passed as `x` and `y` in kwargs, or on batches of `generator`
+        (e.g. DatasetSequence), kwargs are passed to `fit` or `fit_generator` respectively.
+        """
+        from .nn import create_model
+        from .nn import create_callbacks
+
         if create_new:
             if create_dict is None:
                 create_dict = {}
@@ -67,6 +80,8 @@ class GazeNet:
         callbacks = create_callbacks(path_to_save=path_to_save, save_period=save_period)
 
         try:
+            if generator is not None:
+                return self.model.fit_generator(generator, callbacks=callbacks, **kwargs)
             return self.model.fit(callbacks=callbacks, **kwargs)
         finally:
             self.model.save(os.path.join(path_to_save, 'model_last.h5'))
@@ -88,3 +103,29 @@ class GazeNet:
         gaze_vector: ndarray[float, float, float]
         """
         return postprocess(self.model.predict(prepare(eye_image, head_pose)))
+
+    def estimate_gazes(self, eye_images, head_poses, eyes=None):
+        """
+        Predict gaze vectors of several eyes in one forward pass.
+        Right eyes are mirrored to left ones before prediction and predicted gazes are mirrored back.
+
+        Parameters:
+        -----------
+        eye_images: Images Nx72x120, array-like with type uint8
+        head_poses: Vectors Nx3, array-like with type float
+        eyes: list of `left` or `right` for each image, None - all images are left eyes
+
+        Returns:
+        --------
+        gaze_vectors: ndarray[N, 3]
+        """
+        eye_images = asarray(eye_images).reshape(-1, 72, 120)
+        head_poses = asarray(head_poses, dtype=float).reshape(-1, 3)
+        if eyes is None:
+            return gaze2Dto3D(self.model.predict(prepare(eye_images, head_poses)))
+
+        mirror = array([eye == 'right' for eye in eyes])
+        eye_images = where(mirror[:, None, None], eye_images[:, :, ::-1], eye_images)
+        head_poses = where(mirror[:, None], head_poses * self.__FLIP, head_poses)
+        gazes = gaze2Dto3D(self.model.predict(prepare(eye_images, head_poses)))
+        return where(mirror[:, None], gazes * self.__FLIP, gazes)
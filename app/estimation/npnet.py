@@ -0,0 +1,119 @@
+from numpy import load
+from numpy import savez
+from numpy import sqrt
+from numpy import where
+from numpy import expm1
+from numpy import tensordot
+from numpy import concatenate
+from numpy import ascontiguousarray
+from numpy import float32
+from numpy.lib.stride_tricks import as_strided
+
+from .gazenet import GazeNet
+
+
+CONVOLUTIONS = [('conv1', 4), ('conv2', 2), ('conv3', 2)]
+DENSES = ['fc1', 'fc2', 'fc3']
+
+
+def export_weights(path_to_model, path_to_weights):
+    """
+    Dumps weights of trained GazeNet model to numpy archive for NumpyGazeNet.
+
+    Parameters:
+    -----------
+    path_to_model: path to .h5 model created by nn.create_model
+    path_to_weights: path to .npz archive
+    """
+    from keras.models import load_model
+    from .nn import angle_accuracy
+
+    model = load_model(path_to_model, custom_objects={'angle_accuracy': angle_accuracy}, compile=False)
+
+    weights = {}
+    for layer in model.layers:
+        if layer.name in dict(CONVOLUTIONS) or layer.name in DENSES:
+            weights[layer.name + '_kernel'], weights[layer.name + '_bias'] = layer.get_weights()
+        elif layer.__class__.__name__ == 'BatchNormalization':
+            weights['bn_gamma'], weights['bn_beta'], weights['bn_mean'], weights['bn_variance'] = layer.get_weights()
+            weights['bn_epsilon'] = layer.epsilon
+    savez(path_to_weights, **weights)
+
+
+def elu(x):
+    return where(x > 0, x, expm1(x))
+
+
+def conv2d(images, kernel, bias):
+    """
+    Valid convolution with stride 1, images NxHxWxC, kernel KHxKWxCxF as in Keras.
+    """
+    n, h, w, c = images.shape
+    kh, kw = kernel.shape[:2]
+    sn, sh, sw, sc = images.strides
+    windows = as_strided(images, shape=(n, h - kh + 1, w - kw + 1, kh, kw, c), strides=(sn, sh, sw, sh, sw, sc))
+    return tensordot(windows, kernel, axes=([3, 4, 5], [0, 1, 2])) + bias
+
+
+def max_pool(images, size):
+    """
+    Valid max pooling with stride equal to pool size.
+    """
+    n, h, w, c = images.shape
+    h, w = h // size, w // size
+    return images[:, :h * size, :w * size].reshape(n, h, size, w, size, c).max(axis=(2, 4))
+
+
+class NumpyModel:
+    """
+    Inference of nn.create_model architecture in numpy.
+    BatchNormalization is folded into weights of `fc1`, dropout is identity in inference.
+    """
+
+    def __init__(self, weights):
+        self.convolutions = [(weights[name + '_kernel'].astype(float32), weights[name + '_bias'].astype(float32), pool)
+                             for name, pool in CONVOLUTIONS]
+        self.denses = [[weights[name + '_kernel'].astype(float32), weights[name + '_bias'].astype(float32)]
+                       for name in DENSES]
+
+        # BN(x) @ W + b = x @ (scale * W) + (shift @ W + b)
+        scale = weights['bn_gamma'] / sqrt(weights['bn_variance'] + weights['bn_epsilon'])
+        shift = weights['bn_beta'] - weights['bn_mean'] * scale
+        kernel, bias = self.denses[0]
+        self.denses[0] = [(scale[:, None] * kernel).astype(float32), (shift @ kernel + bias).astype(float32)]
+
+    def predict_batch(self, images, poses):
+        x = ascontiguousarray(images, dtype=float32)
+        for kernel, bias, pool in self.convolutions:
+            x = max_pool(elu(conv2d(x, kernel, bias)), pool)
+        x = concatenate([x.reshape(len(x), -1), poses.astype(float32)], axis=1)
+        for kernel, bias in self.denses[:-1]:
+            x = elu(x @ kernel + bias)
+        kernel, bias = self.denses[-1]
+        return x @ kernel + bias
+
+    def predict(self, inputs, batch_size=32):
+        images, poses = inputs
+        return concatenate([self.predict_batch(images[i:i + batch_size], poses[i:i + batch_size])
+                            for i in range(0, max(len(images), 1), batch_size)])
+
+
+class NumpyGazeNet(GazeNet):
+    """
+    GazeNet which runs inference in numpy, without Keras and TensorFlow.
+
+    Examples
+    --------
+
+    >>> export_weights('./app/bin/estimator.h5', './app/bin/estimator.npz')
+    >>> model = NumpyGazeNet().init('./app/bin/estimator.npz')
+    >>> gaze = model.estimate_gaze(eye_image, head_pose)
+    """
+
+    def init(self, path_to_weights):
+        with load(path_to_weights) as weights:
+            self.model = NumpyModel(dict(weights))
+        return self
+
+    def train(self, *args, **kwargs):
+        raise Exception('NumpyGazeNet supports only inference, train GazeNet and export its weights.')
@@ -6,6 +6,9 @@ from cv2 import COLOR_BGR2GRAY
 
 from numpy.random import permutation
 from numpy import array
+from numpy import arange
+from numpy import asarray
+from numpy import concatenate
 from numpy import fliplr
 from numpy import tile
 from os import path
@@ -13,6 +16,7 @@ from os import path
 from app.estimation.transform import gaze3Dto2D
 from app.estimation.transform import pose3Dto2D
 from app.estimation.transform import angles_between_vectors
+from app.estimation.store import EyePatchStore
 
 
 def get_item(data: dict, path_list: list):
@@ -31,6 +35,39 @@ def get_path_list(path, **kargs):
     return path.format(**kargs).split('/')[::-1]
 
 
+def _to_key(key):
+    try:
+        return int(key)
+    except ValueError:
+        return key
+
+
+def compile_path(path, **kwargs):
+    """
+    Splits path template into lists of keys before and after `{index}`.
+    Other formatter keys are filled from `kwargs`.
+
+    >>> compile_path('dataset/{index}/eyes/{eye}/image', eye='left')
+    (['dataset'], ['eyes', 'left', 'image'])
+    """
+    head, tail = path.format(index='{index}', **kwargs).split('{index}')
+    return [_to_key(key) for key in head.split('/') if key], [_to_key(key) for key in tail.split('/') if key]
+
+
+def walk(data, keys):
+    for key in keys:
+        data = data[key]
+    return data
+
+
+def get_column(data, path, **kwargs):
+    """
+    Extracts value pointed by path template from every sample.
+    """
+    head, tail = compile_path(path, **kwargs)
+    return [walk(sample, tail) for sample in walk(data, head)]
+
+
 class DatasetParser:
     """
     Parser for output data from Normalisation module.
@@ -92,10 +129,20 @@ class DatasetParser:
         self.shape = None
         self.path_to_images = None
 
+        # columns extracted from json by `fit`
+        self._poses = None
+        self._gazes = None
+        self._images = None
+
+        # eye patches of dataset written to EyePatchStore
+        self.store = None
+
     def fit(self, jsonfile, path_to_images):
         """
         Reads specific json file to parser.
         Memorizes `path_to_image` files.
+        Extracts poses, gazes and image names of all samples into arrays.
+        If images are rows of EyePatchStore, memory-maps the store and takes gazes and poses from its labels.
         Counts samples in the json data and write to DataserParser.shape.
 
         Parameters
@@ -111,20 +158,32 @@ class DatasetParser:
         """
         self.path_to_images = path_to_images
         self.data = load(jsonfile)
+        self._images = {eye: array(get_column(self.data, self.images, eye=eye)) for eye in self.__EYES}
+        if self._images['left'].dtype.kind in 'iu':
+            self.store = EyePatchStore(path_to_images)
+            _, labels = self.store.open()
+            # gazes and poses are labels of the patches, both patches of a sample have its pose
+            self._gazes = {eye: labels[self._images[eye], :3].astype(float) for eye in self.__EYES}
+            self._poses = labels[self._images['left'], 3:].astype(float)
+        else:
+            self.store = None
+            self._poses = array(get_column(self.data, self.poses), dtype=float).reshape(-1, 3)
+            self._gazes = {eye: array(get_column(self.data, self.gazes, eye=eye), dtype=float).reshape(-1, 3)
+                           for eye in self.__EYES}
         self.shape = len(self)
         return self
 
     def __len__(self):
-        path_to_samples = self.images.split('{')[0][:-1].split('/')[::-1]
-        return len(get_item(self.data, path_to_samples))
+        return len(self._poses)
 
     def _check_indices(self, indices):
         if indices is not None:
-            max_index = max(indices)
+            indices = array(indices, dtype=int)
+            max_index = indices.max()
             assert max_index < self.shape - 1, f'Index {max_index} is out of range.'
             return indices
         else:
-            return range(self.shape)
+            return arange(self.shape)
 
     def _check_eye(self, eye):
         assert eye in self.__EYES, 'Wrong eye. There are only `left` and `right`.'
@@ -147,17 +206,10 @@ class DatasetParser:
         image : array-like
         """
         self._check_eye(eye)
-        path_to_image = path.join(
-            self.path_to_images,
-            get_item(
-                self.data,
-                get_path_list(
-                    self.images,
-                    index=index,
-                    eye=eye
-                )
-            )
-        )
+        if self.store is not None:
+            image = self.store.patches[self._images[eye][index]]
+            return image[:, ::-1] if flip else image
+        path_to_image = path.join(self.path_to_images, self._images[eye][index])
         image = imread(path_to_image)
         if image is None:
             raise Exception(f'Image not found in {path_to_image}')
@@ -181,11 +233,11 @@ class DatasetParser:
         -------
         pose : list[float, float, float]
         """
-        vector = array(get_item(self.data, get_path_list(self.poses, index=index))).reshape(3,)
+        vector = self._poses[index]
         if flip:
             return vector * self.__FLIP
         else:
-            return vector
+            return vector.copy()
 
     def get_gaze(self, index, eye, flip=False):
         """
@@ -203,13 +255,13 @@ class DatasetParser:
         gaze : list[float, float, float]
         """
         self._check_eye(eye)
-        vector = array(get_item(self.data, get_path_list(self.gazes, eye=eye, index=index))).reshape(3,)
+        vector = self._gazes[eye][index]
         if flip:
             return vector * self.__FLIP
         else:
-            return vector
+            return vector.copy()
 
-    def get_poses_array(self, indices=None, **kwargs):
+    def get_poses_array(self, indices=None, flip=False):
         """
         Returns batch of pose vectors of samples which number in `indices`.
 
@@ -220,11 +272,14 @@ class DatasetParser:
 
         Returns
         -------
-        poses : list[list[float, float, float]]
+        poses : ndarray[N, 3]
         """
-        return [self.get_pose(index, **kwargs) for index in self._check_indices(indices)]
+        poses = self._poses[self._check_indices(indices)]
+        if flip:
+            poses *= self.__FLIP
+        return poses
 
-    def get_gazes_array(self, eye, indices=None, **kwargs):
+    def get_gazes_array(self, eye, indices=None, flip=False):
         """
         Returns batch of gaze vectors of samples which number in `indices`.
 
@@ -237,10 +292,13 @@ class DatasetParser:
 
         Returns
         -------
-        gazes : list[list[float, float, float]]
+        gazes : ndarray[N, 3]
         """
         self._check_eye(eye)
-        return [self.get_gaze(index, eye=eye, **kwargs) for index in self._check_indices(indices)]
+        gazes = self._gazes[eye][self._check_indices(indices)]
+        if flip:
+            gazes *= self.__FLIP
+        return gazes
 
     def get_images_array(self, eye, indices=None, **kwargs):
         """
@@ -255,24 +313,27 @@ class DatasetParser:
 
         Returns
         -------
-        gazes : list[array-like]
+        images : list[array-like] or ndarray[N, 72, 120] for EyePatchStore
         """
         self._check_eye(eye)
+        if self.store is not None:
+            images = self.store.get_patches(self._images[eye][self._check_indices(indices)])
+            return images[:, :, ::-1] if kwargs.get('flip') else images
         return [self.get_image(index, eye, **kwargs) for index in self._check_indices(indices)]
 
     def get_full_data(self, indices=None):
 
-        eyes, poses, gazes = [], [], []
-
-        for flip, eye in enumerate(self.__EYES):
-            # flip = 0
-            eyes.extend(self.get_images_array(eye=eye, flip=bool(flip), indices=indices))
-            poses.extend(self.get_poses_array(indices=indices, flip=bool(flip)))
-            gazes.extend(self.get_gazes_array(eye=eye, indices=indices, flip=bool(flip)))
-
-        eyes = (array(eyes, subok=True).reshape(-1, 72, 120, 1) / 255)
-        angles = angles_between_vectors(array(gazes, subok=True), array(poses, subok=True))
-        gazes = gaze3Dto2D(array(gazes, subok=True))
-        poses = gaze3Dto2D(array(poses, subok=True))
+        # indices are checked by each getter
+        eyes = concatenate([asarray(self.get_images_array(eye=eye, flip=bool(flip), indices=indices))
+                            for flip, eye in enumerate(self.__EYES)])
+        poses = concatenate([self.get_poses_array(indices=indices, flip=bool(flip))
+                             for flip, eye in enumerate(self.__EYES)])
+        gazes = concatenate([self.get_gazes_array(eye=eye, indices=indices, flip=bool(flip))
+                             for flip, eye in enumerate(self.__EYES)])
+
+        eyes = eyes.reshape(-1, 72, 120, 1) / 255
+        angles = angles_between_vectors(gazes, poses)
+        gazes = gaze3Dto2D(gazes)
+        poses = gaze3Dto2D(poses)
         # poses = tile(pose3Dto2D(array(poses, subok=True)).mean(axis=0), (gazes.shape[0], 1))
         return eyes, poses, gazes, angles
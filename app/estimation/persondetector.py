@@ -1,22 +1,104 @@
-from app.actor import Person
-
-from dlib import shape_predictor
-from dlib import rectangle as DlibRectangle
-from dlib import rectangles as DlibRectangles
+from multiprocessing import Pool
+from os import cpu_count
 
-from scipy.io import loadmat
+from app.actor import Person
 
 from cv2 import resize
 from cv2 import cvtColor
 from cv2 import COLOR_BGR2GRAY
 from cv2 import solvePnP
+from cv2 import projectPoints
 from cv2 import SOLVEPNP_ITERATIVE
 from cv2 import Rodrigues
 from cv2 import CascadeClassifier
+from cv2 import TERM_CRITERIA_COUNT
+from cv2 import TERM_CRITERIA_EPS
+
+try:
+    # OpenCV >= 4.1
+    from cv2 import solvePnPRefineLM
+except ImportError:
+    solvePnPRefineLM = None
 
 from numpy import array
 from numpy import tile
 from numpy import concatenate
+from numpy import sqrt
+from numpy import ptp
+from numpy import isfinite
+from numpy import diag
+from numpy.linalg import solve
+from numpy.linalg import LinAlgError
+
+
+# detector of a worker process, see PersonDetector.detect_persons_batch
+_worker_detector = None
+
+
+def _init_worker(detector):
+    global _worker_detector
+    _worker_detector = detector
+
+
+def _detect_persons_chunk(frames, origin):
+    # frames of a chunk are consecutive, faces are tracked inside the chunk only
+    _worker_detector.reset()
+    return [_worker_detector.detect_persons(frame, origin) for frame in frames]
+
+
+def refine_pose(model_points, image_points, matrix, distortion, rotation_vector, translation_vector, iterations):
+    """
+    At most `iterations` Levenberg-Marquardt steps of reprojection error, as solvePnPRefineLM of OpenCV >= 4.1 does.
+    :return: rotation vector, translation vector
+    """
+    pose = concatenate([rotation_vector.reshape(3), translation_vector.reshape(3)]).astype(float)
+    image_points = image_points.reshape(-1).astype(float)
+
+    def project(pose):
+        projected, jacobian = projectPoints(model_points, pose[:3], pose[3:], matrix, distortion)
+        residual = projected.reshape(-1) - image_points
+        return residual, residual @ residual, jacobian[:, :6]
+
+    residual, error, jacobian = project(pose)
+    damping = 1e-3
+    for _ in range(iterations):
+        hessian = jacobian.T @ jacobian
+        try:
+            step = solve(hessian + damping * diag(diag(hessian)), jacobian.T @ residual)
+        except LinAlgError:
+            break
+        new_residual, new_error, new_jacobian = project(pose - step)
+        if new_error < error:
+            pose, residual, error, jacobian = pose - step, new_residual, new_error, new_jacobian
+            damping /= 10
+        else:
+            damping *= 10
+    return pose[:3].reshape(3, 1), pose[3:].reshape(3, 1)
+
+
+def solve_pose(model_points, image_points, matrix, distortion, guess=None, iterations=2):
+    """
+    Pose of the model relative to the camera.
+    From scratch the pose is found by solvePnP, its iterations are not limited.
+    From a guess at most `iterations` Levenberg-Marquardt steps are done: by solvePnPRefineLM on OpenCV >= 4.1,
+    by `refine_pose` on older versions (3.4 of requirements.txt has no solvePnPRefineLM).
+    :param guess: tuple(rotation vector, translation vector) of the previous frame to start from,
+        None - solve from scratch
+    :param iterations: maximum number of Levenberg-Marquardt iterations when started from the guess
+    :return: success, rotation vector, translation vector
+    """
+    if guess is None:
+        return solvePnP(model_points, image_points, matrix, distortion, flags=SOLVEPNP_ITERATIVE)
+
+    rotation_vector, translation_vector = guess[0].copy(), guess[1].copy()
+    if solvePnPRefineLM is not None:
+        solvePnPRefineLM(model_points, image_points, matrix, distortion, rotation_vector, translation_vector,
+                         (TERM_CRITERIA_COUNT + TERM_CRITERIA_EPS, iterations, 1e-6))
+    else:
+        rotation_vector, translation_vector = refine_pose(model_points, image_points, matrix, distortion,
+                                                          rotation_vector, translation_vector, iterations)
+    success = isfinite(rotation_vector).all() and isfinite(translation_vector).all()
+    return success, rotation_vector, translation_vector
 
 
 class PersonDetector:
@@ -31,7 +113,39 @@ class PersonDetector:
     landmarks_to_model = [30, 8, 36, 45, 48, 54]
 
     def __init__(self, path_to_face_model, path_to_face_points, path_to_hc_model, factor, scale=1.3, minNeighbors=5,
-                 chin_nose_distance=0.065):
+                 chin_nose_distance=0.065, tracking=False, redetect_every=10, max_scale_change=1.3,
+                 max_shift=0.3, pose_iterations=2):
+        """
+        :param tracking: reuse faces of the previous frame of the same camera instead of running the cascade
+            on each frame, frames must be passed in order, call `reset` before another sequence of frames
+        :param redetect_every: in tracking mode, run the cascade every `redetect_every` frames to find new faces
+        :param max_scale_change: tracked face is lost if its size changes more than in this ratio between frames
+        :param max_shift: tracked face is lost if it moves more than this part of its size between frames
+        :param pose_iterations: in tracking mode, head pose of a tracked face is refined from its previous pose
+            with at most `pose_iterations` iterations
+        """
+
+        # parameters to recreate the detector in worker processes, dlib and cv2 models are not picklable
+        self._params = {
+            'path_to_face_model': path_to_face_model,
+            'path_to_face_points': path_to_face_points,
+            'path_to_hc_model': path_to_hc_model,
+            'factor': factor,
+            'scale': scale,
+            'minNeighbors': minNeighbors,
+            'chin_nose_distance': chin_nose_distance,
+            'tracking': tracking,
+            'redetect_every': redetect_every,
+            'max_scale_change': max_scale_change,
+            'max_shift': max_shift,
+            'pose_iterations': pose_iterations
+        }
+        self._pool = None
+        self._processes = None
+
+        # dlib and scipy are imported on demand, so importing app does not need them
+        from dlib import shape_predictor
+        from scipy.io import loadmat
 
         # init face detector model
         self.detector = CascadeClassifier(path_to_hc_model).detectMultiScale
@@ -52,6 +166,60 @@ class PersonDetector:
         self.model_points = self.model_points * face_scale
         self.nose_chin_distance = chin_nose_distance
 
+        # constant points of the face in model space: nose, chin, eye centers and eye rectangles, 3xN
+        eye_centers_model_space = self.model_points[2:4] + array([[-self.eye_width/2, 0., 0.],
+                                                                  [self.eye_width/2, 0., 0.]])
+        eye_rectangles_model_space = self._eye_rectangles(*self.model_points[2:4])
+        self.face_model_space = concatenate([self.model_points[:2],
+                                             eye_centers_model_space,
+                                             eye_rectangles_model_space], axis=0).T
+
+        # parameters of tracking mode
+        self.tracking = tracking
+        self.redetect_every = redetect_every
+        self.max_scale_change = max_scale_change
+        self.max_shift = max_shift
+        self.pose_iterations = pose_iterations
+        self.reset()
+
+    def __getstate__(self):
+        return self._params.copy()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def open_pool(self, processes=None):
+        """
+        Starts worker processes of detect_persons_batch, e.g. before heavy libraries are loaded or threads are
+        started, so workers are forked from a clean process.
+        :param processes: number of worker processes, None - number of cores, 1 - no workers
+        :return: number of worker processes
+        """
+        processes = processes or cpu_count() or 1
+        if processes > 1 and (self._pool is None or self._processes != processes):
+            self.close()
+            self._pool = Pool(processes, initializer=_init_worker, initargs=(self,))
+            self._processes = processes
+        return processes
+
+    def close(self):
+        """
+        Stops worker processes of detect_persons_batch.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        self._processes = None
+
+    def reset(self):
+        """
+        Forgets tracked faces, the next frame runs full detection.
+        """
+        # faces of the previous frame of each camera in downscaled image: camera name ->
+        # (list of [cv2 rectangle x, y, w, h, dlib landmarks 68x2, head pose or None], frames since detection)
+        self._tracks = {}
+
     def rescale_coordinates(self, coords):
         return (coords * self.factor).astype(int)
 
@@ -70,6 +238,8 @@ class PersonDetector:
 
     @staticmethod
     def cvface2dlibrects(cvfaces):
+        from dlib import rectangle as DlibRectangle
+        from dlib import rectangles as DlibRectangles
         return DlibRectangles([DlibRectangle(*cvface[:2], *(cvface[:2] + cvface[2:]))
                                for cvface in cvfaces])
 
@@ -102,38 +272,89 @@ class PersonDetector:
 
         return array([right_eye_rectangle_model_space, left_eye_rectangle_model_space]).reshape(-1, 3)
 
-    def extract_faces(self, image):
+    @staticmethod
+    def _landmarks_box(landmarks):
+        """
+        Center and size of landmarks bounding box.
+        """
+        return (landmarks.max(axis=0) + landmarks.min(axis=0)) / 2, sqrt(ptp(landmarks[:, 0]) * ptp(landmarks[:, 1]))
+
+    def _detect_faces(self, image_for_detector):
+        cvfaces = self.detector(image_for_detector, scaleFactor=self.scale, minNeighbors=self.minNeighbors)
+        return [[array(cvface, dtype=float), self.shape_to_np(self.predictor(image_for_detector, rectangle)), None]
+                for cvface, rectangle in zip(cvfaces, self.cvface2dlibrects(cvfaces))]
+
+    def _track_faces(self, image_for_detector, tracked_faces):
+        """
+        Runs only landmarks detector in rectangles of faces of the previous frame.
+        Rectangles follow shift and scale of the landmarks.
+        :return: tracked faces, or None if any face is lost
+        """
+        height, width = image_for_detector.shape[:2]
+        faces = []
+        for cvface, previous_landmarks, pose in tracked_faces:
+            rectangle = self.cvface2dlibrects([cvface.round().astype(int)])[0]
+            landmarks = self.shape_to_np(self.predictor(image_for_detector, rectangle))
+
+            previous_center, previous_size = self._landmarks_box(previous_landmarks)
+            center, size = self._landmarks_box(landmarks)
+            scale_change = size / max(previous_size, 1.)
+            if not 1 / self.max_scale_change < scale_change < self.max_scale_change or \
+                    (abs(center - previous_center) > self.max_shift * previous_size).any() or \
+                    not (0 <= center[0] < width and 0 <= center[1] < height):
+                return None
+
+            # rectangle keeps its position relative to the landmarks
+            face_center = cvface[:2] + cvface[2:] / 2
+            face_size = cvface[2:] * scale_change
+            face_center = center + (face_center - previous_center) * scale_change
+            faces.append([concatenate([face_center - face_size / 2, face_size]), landmarks, pose])
+        return faces
+
+    def extract_faces(self, image, camera_name=None):
 
         # downscale image for faster detection
         image_for_detector = self.downscale(self.to_grayscale(image))
 
-        # detect faces and return cv2-friendly rectangles
-        rectangles = self.cvface2dlibrects(self.detector(image_for_detector,
-                                                         scaleFactor=self.scale,
-                                                         minNeighbors=self.minNeighbors))
+        faces = None
+        tracked_faces, frames_since_detection = self._tracks.get(camera_name, ([], 0))
+        if self.tracking and tracked_faces and frames_since_detection + 1 < self.redetect_every:
+            faces = self._track_faces(image_for_detector, tracked_faces)
+            frames_since_detection += 1
+        if faces is None:
+            # detect faces by cascade and landmarks in its cv2-friendly rectangles
+            faces = self._detect_faces(image_for_detector)
+            frames_since_detection = 0
+        if self.tracking:
+            self._tracks[camera_name] = faces, frames_since_detection
 
         # raw 2d dlib landmarks
-        raw_dlib_faces = [self.rescale_coordinates(self.shape_to_np(self.predictor(image_for_detector, rectangle)))
-                          for rectangle in rectangles]
+        raw_dlib_faces = [self.rescale_coordinates(landmarks) for _, landmarks, _ in faces]
 
         return raw_dlib_faces, self._extract_face_landmarks(raw_dlib_faces=raw_dlib_faces)
 
-    def detect_person(self, name, extracted_face, camera, origin, raw_dlib_face=None):
+    def detect_person(self, name, extracted_face, camera, origin, raw_dlib_face=None, face=None):
+        """
+        :param face: tracked face of extract_faces, its head pose is used as initial guess and updated
+        """
 
         person_face_landmarks_2d = array(extracted_face, dtype="double")
-        success, rotation_vector, translation_vector = solvePnP(self.model_points,
-                                                                person_face_landmarks_2d,
-                                                                camera.matrix,
-                                                                camera.distortion,
-                                                                flags=SOLVEPNP_ITERATIVE)
-
-        eye_centers_model_space = self.model_points[2:4] + array([[-self.eye_width/2, 0., 0.],
-                                                                  [self.eye_width/2, 0., 0.]])
-        eye_rectangles_model_space = self._eye_rectangles(*self.model_points[2:4])
-        face_model_space = concatenate([self.model_points[:2],
-                                        eye_centers_model_space,
-                                        eye_rectangles_model_space], axis=0).T
-        face_model_origin_space = self._vectors_from_model_to_origin(face_model_space,
+        guess = face[2] if face is not None else None
+        success, rotation_vector, translation_vector = solve_pose(self.model_points,
+                                                                  person_face_landmarks_2d,
+                                                                  camera.matrix,
+                                                                  camera.distortion,
+                                                                  guess=guess,
+                                                                  iterations=self.pose_iterations)
+        if guess is not None and not success:
+            success, rotation_vector, translation_vector = solve_pose(self.model_points,
+                                                                      person_face_landmarks_2d,
+                                                                      camera.matrix,
+                                                                      camera.distortion)
+        if face is not None:
+            face[2] = (rotation_vector, translation_vector) if success else None
+
+        face_model_origin_space = self._vectors_from_model_to_origin(self.face_model_space,
                                                                      rotation_vector,
                                                                      translation_vector,
                                                                      camera).T
@@ -152,13 +373,95 @@ class PersonDetector:
     def detect_persons(self, frame, origin):
 
         # find faces on image
-        raw_dlib_faces, extracted_faces_2d = self.extract_faces(frame.image)
+        raw_dlib_faces, extracted_faces_2d = self.extract_faces(frame.image, camera_name=frame.camera.name)
+
+        # tracked faces keep head poses for the next frame
+        tracked_faces = self._tracks[frame.camera.name][0] if self.tracking else [None] * len(extracted_faces_2d)
 
         persons = [self.detect_person(name=f'Person{i}',
                                       extracted_face=face,
                                       camera=frame.camera,
                                       origin=origin,
-                                      raw_dlib_face=raw_dlib_faces[i])
+                                      raw_dlib_face=raw_dlib_faces[i],
+                                      face=tracked_faces[i])
                    for i, face in enumerate(extracted_faces_2d)]
 
         return persons
+
+    def detect_persons_batch(self, frames, origin, processes=None, chunksize=None):
+        """
+        Detects persons on a list of frames in a pool of worker processes, each worker owns its detector.
+        Frames are split into chunks of consecutive frames, faces are tracked inside a chunk.
+        :param frames: list of Frame
+        :param processes: number of worker processes, None - number of cores, 1 - detect in this process
+        :param chunksize: number of frames sent to a worker at once, None - split frames evenly between workers
+        :return: list of lists of persons, one list for each frame
+        """
+        frames = list(frames)
+        processes = processes or cpu_count() or 1
+        if processes == 1 or len(frames) < 2:
+            return [self.detect_persons(frame, origin) for frame in frames]
+
+        self.open_pool(processes)
+
+        chunksize = chunksize or -(-len(frames) // processes)
+        chunks = [frames[i:i + chunksize] for i in range(0, len(frames), chunksize)]
+        persons_batch = [persons for persons_chunk in self._pool.starmap(_detect_persons_chunk,
+                                                                         [(chunk, origin) for chunk in chunks])
+                         for persons in persons_chunk]
+
+        # persons are unpickled with a copy of the origin
+        for persons in persons_batch:
+            for person in persons:
+                person.origin = origin
+        return persons_batch
+
+
+if __name__ == '__main__':
+
+    # latency of head pose per face: python -m app.estimation.persondetector
+    from timeit import timeit
+    from numpy import eye
+    from numpy.random import RandomState
+
+    random = RandomState(0)
+    model_points = array([[0., 0., 0.], [0., -0.065, -0.013], [-0.044, 0.034, -0.026],
+                          [0.044, 0.034, -0.026], [-0.029, -0.029, -0.024], [0.029, -0.029, -0.024]])
+    matrix = array([[1500., 0., 640.], [0., 1500., 512.], [0., 0., 1.]])
+    distortion = array([0., 0., 0., 0., 0.])
+
+    # slowly moving head, as on consecutive frames of live mode
+    frames = 300
+    rotations = (array([0., 3.1, 0.]) + random.randn(frames, 3).cumsum(axis=0) * 0.005).reshape(-1, 3, 1)
+    translations = (array([0., 0., 0.7]) + random.randn(frames, 3).cumsum(axis=0) * 0.002).reshape(-1, 3, 1)
+    points = [projectPoints(model_points, rotation, translation, matrix, distortion)[0].reshape(-1, 2) +
+              random.randn(6, 2) * 0.5 for rotation, translation in zip(rotations, translations)]
+
+    def solve_cold():
+        return [solve_pose(model_points, image_points, matrix, distortion) for image_points in points]
+
+    def solve_warm():
+        poses, pose = [], None
+        for image_points in points:
+            success, rotation_vector, translation_vector = solve_pose(model_points, image_points, matrix, distortion,
+                                                                      guess=pose)
+            pose = rotation_vector, translation_vector
+            poses.append((success, rotation_vector, translation_vector))
+        return poses
+
+    def solve_warm_numpy():
+        # path of OpenCV < 4.1
+        global solvePnPRefineLM
+        solvePnPRefineLM, refine_lm = None, solvePnPRefineLM
+        try:
+            return solve_warm()
+        finally:
+            solvePnPRefineLM = refine_lm
+
+    for name, function in [('solvePnP from scratch', solve_cold), ('warm start from previous pose', solve_warm),
+                           ('warm start by refine_pose', solve_warm_numpy)]:
+        seconds = timeit(function, number=10) / 10 / frames
+        poses = function()
+        error = max(abs(Rodrigues(rotation)[0] @ Rodrigues(pose[1])[0].T - eye(3)).max()
+                    for rotation, pose in zip(rotations, poses))
+        print(f'{name:30} {seconds * 1e6:8.1f} us per face, max rotation error {error:.4f}')
@@ -0,0 +1,116 @@
+from os import path
+
+from keras.utils import Sequence
+
+from numpy import arange
+from numpy import concatenate
+from numpy import empty
+from numpy import full
+from numpy import float32
+from numpy import int32
+from numpy.random import RandomState
+
+from app.estimation.parser import DatasetParser
+from app.estimation.transform import gaze3Dto2D
+
+
+def load_sessions(sessions, parser_params, json_name='normalized_dataset.json'):
+    """
+    Fits DatasetParser to each session, keeps only extracted labels of samples.
+
+    Parameters
+    ----------
+    sessions : list[str]
+        Paths to folders with `normalized_dataset.json` and eye images.
+    parser_params : dict
+        Key arguments for DatasetParser.
+
+    Returns
+    -------
+    parsers : list[DatasetParser]
+    """
+    parsers = []
+    for session in sessions:
+        parser = DatasetParser(**parser_params)
+        with open(path.join(session, json_name), 'r') as session_data:
+            parser.fit(jsonfile=session_data, path_to_images=session)
+        # labels are extracted into arrays by fit, raw json is not needed anymore
+        parser.data = None
+        parsers.append(parser)
+    return parsers
+
+
+class DatasetSequence(Sequence):
+    """
+    Keras Sequence streaming batches of eye images, poses and gazes from fitted DatasetParsers.
+
+    Only labels of samples are kept in memory, eye images are loaded for each batch and normalized
+    to float32, so memory does not grow with the number of sessions. Right eyes are flipped as in
+    DatasetParser.get_full_data.
+
+    Parameters
+    ----------
+    parsers : list[DatasetParser]
+        Parsers fitted to sessions, see `load_sessions`.
+    indices : list[1D array-like] or None
+        Indices of samples for each parser, None - all samples.
+    batch_size : int
+        Number of eye images in a batch.
+    shuffle : bool
+        Shuffle samples of all sessions after each epoch.
+
+    Examples
+    --------
+
+    >>> train_data = DatasetSequence(load_sessions(sessions, DATASET_PARSER), batch_size=512)
+    >>> GazeNet().train(path_to_save, generator=train_data, epochs=100, workers=4, use_multiprocessing=True)
+    """
+
+    __EYES = ['left', 'right']
+
+    def __init__(self, parsers, indices=None, batch_size=512, shuffle=True, seed=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random = RandomState(seed)
+
+        self.parsers = parsers
+        session_ids, sample_ids, flips, poses, gazes = [], [], [], [], []
+
+        for session_id, parser in enumerate(parsers):
+            # getters check indices themselves, so they get indices as they are given
+            given_indices = None if indices is None else indices[session_id]
+            session_indices = parser._check_indices(given_indices)
+            for flip, eye in enumerate(self.__EYES):
+                session_ids.append(full(len(session_indices), session_id, dtype=int32))
+                sample_ids.append(session_indices.astype(int32))
+                flips.append(full(len(session_indices), flip, dtype=bool))
+                poses.append(gaze3Dto2D(parser.get_poses_array(indices=given_indices, flip=bool(flip))))
+                gazes.append(gaze3Dto2D(parser.get_gazes_array(eye, indices=given_indices, flip=bool(flip))))
+
+        self.session_ids = concatenate(session_ids) if session_ids else empty(0, dtype=int32)
+        self.sample_ids = concatenate(sample_ids) if sample_ids else empty(0, dtype=int32)
+        self.flips = concatenate(flips) if flips else empty(0, dtype=bool)
+        self.poses = concatenate(poses).astype(float32) if poses else empty((0, 2), dtype=float32)
+        self.gazes = concatenate(gazes).astype(float32) if gazes else empty((0, 2), dtype=float32)
+
+        self.order = arange(len(self.sample_ids))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, batch):
+        ids = self.order[batch * self.batch_size:(batch + 1) * self.batch_size]
+
+        eyes = empty((len(ids), 72, 120, 1), dtype=float32)
+        for i, sample in enumerate(ids):
+            eye = self.__EYES[int(self.flips[sample])]
+            eyes[i, :, :, 0] = self.parsers[self.session_ids[sample]].get_image(self.sample_ids[sample], eye,
+                                                                                flip=bool(self.flips[sample]))
+        eyes /= 255
+
+        return [eyes, self.poses[ids]], self.gazes[ids]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random.shuffle(self.order)
@@ -0,0 +1,124 @@
+from os import path as Path
+
+from numpy import array
+from numpy import asarray
+from numpy import ascontiguousarray
+from numpy import diff
+from numpy import empty
+from numpy import memmap
+from numpy import float32
+from numpy import uint8
+
+
+class EyePatchStore:
+    """
+    Append-only storage of normalized eye patches and their labels.
+    A new store starts empty: files of a previous pass are truncated by its first `append`.
+
+    Data is kept in two raw files in the dataset folder:
+        eye_patches.u8 -- uint8 array N x 72 x 120, one row per eye patch;
+        eye_labels.f4 -- float32 array N x 6, `gaze_norm` and `rotation_norm` of each patch.
+    Images of `normalized_dataset.json` keep row numbers of the patches instead of png names,
+    DatasetParser reads gazes and poses from the labels.
+
+    Examples
+    --------
+
+    >>> store = EyePatchStore('/path/to/session')
+    >>> row = store.append(eye_image, gaze_norm, rotation_norm)
+    >>> store.close()
+
+    >>> patches, labels = EyePatchStore('/path/to/session').open()
+    """
+
+    patches_file = 'eye_patches.u8'
+    labels_file = 'eye_labels.f4'
+
+    resolution = (72, 120)
+    labels_size = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.patches = None
+        self.labels = None
+
+        # files opened for writing, truncated when opened
+        self._patches_out = None
+        self._labels_out = None
+
+    @classmethod
+    def exists(cls, path):
+        return Path.isfile(Path.join(path, cls.patches_file))
+
+    def __len__(self):
+        patches_path = Path.join(self.path, self.patches_file)
+        if not Path.isfile(patches_path):
+            return 0
+        return Path.getsize(patches_path) // (self.resolution[0] * self.resolution[1])
+
+    def append(self, patch, gaze, pose):
+        """
+        Appends eye patch with its labels.
+
+        Parameters
+        ----------
+        patch : array-like
+            Grayscale image 72x120.
+        gaze : array-like
+            Normalized gaze vector.
+        pose : array-like
+            Normalized head pose vector.
+
+        Returns
+        -------
+        row : int
+            Row of the patch in the store.
+        """
+        patch = asarray(patch)
+        if patch.shape != self.resolution:
+            raise Exception(f'Eye patch must be grayscale {self.resolution[0]}x{self.resolution[1]}, '
+                            f'got {patch.shape}.')
+        if self._patches_out is None:
+            self._patches_out = open(Path.join(self.path, self.patches_file), mode='wb')
+            self._labels_out = open(Path.join(self.path, self.labels_file), mode='wb')
+
+        row = self._patches_out.tell() // patch.size
+        self._patches_out.write(ascontiguousarray(patch, dtype=uint8).tobytes())
+        self._labels_out.write(array([*asarray(gaze).reshape(3), *asarray(pose).reshape(3)], dtype=float32).tobytes())
+        return row
+
+    def close(self):
+        if self._patches_out is not None:
+            self._patches_out.close()
+            self._labels_out.close()
+        self._patches_out = None
+        self._labels_out = None
+
+    def open(self):
+        """
+        Memory-maps stored patches and labels for reading.
+
+        Returns
+        -------
+        patches : ndarray[N, 72, 120] with type uint8
+        labels : ndarray[N, 6] with type float32
+        """
+        length = len(self)
+        if length:
+            self.patches = memmap(Path.join(self.path, self.patches_file), dtype=uint8, mode='r',
+                                  shape=(length, *self.resolution))
+            self.labels = memmap(Path.join(self.path, self.labels_file), dtype=float32, mode='r',
+                                 shape=(length, self.labels_size))
+        else:
+            self.patches = empty((0, *self.resolution), dtype=uint8)
+            self.labels = empty((0, self.labels_size), dtype=float32)
+        return self.patches, self.labels
+
+    def get_patches(self, rows):
+        """
+        Returns patches of `rows`, consecutive rows are returned as a view without copying.
+        """
+        rows = asarray(rows, dtype=int)
+        if len(rows) and (diff(rows) == 1).all():
+            return self.patches[rows[0]:rows[-1] + 1]
+        return self.patches[rows]
@@ -1,5 +1,4 @@
 import numpy as np
-from cv2 import Rodrigues
 
 
 def gaze3Dto2D(vectors, stack=True):
@@ -7,12 +6,12 @@ def gaze3Dto2D(vectors, stack=True):
     theta = asin(-y) -- pitch
     phi = atan2(-x, -z) -- yaw
     """
+    vectors = np.asarray(vectors)
     if vectors.ndim == 2:
         assert vectors.shape[1] == 3
-        x, y, z = (vectors[:, i] for i in range(3))
     elif vectors.ndim == 1:
         assert vectors.shape[0] == 3
-        x, y, z = (vectors[i] for i in range(3))
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
 
     pitch = np.arcsin(-y)  # pitch
     yaw = np.arctan2(-x, -z)  # yaw
@@ -28,22 +27,61 @@ def gaze2Dto3D(angles):
     x = (-1) * cos(theta) * sin(phi)
     y = (-1) * sin(theta)
     z = (-1) * cos(theta) * cos(phi)
+
+    Vectors are unit by construction, so they are not normalized.
     """
+    angles = np.asarray(angles)
     if angles.ndim == 2:
         assert angles.shape[1] == 2
-        yaw, pitch = (angles[:, i] for i in range(2))
     elif angles.ndim == 1:
         assert angles.shape[0] == 2
-        yaw, pitch = (angles[i] for i in range(2))
+    angles = angles.reshape(-1, 2)
+    yaw, pitch = angles[:, 0], angles[:, 1]
+
+    vectors = np.empty((len(angles), 3), dtype=np.result_type(angles.dtype, np.float32))
+    cos_pitch = np.cos(pitch)
+    np.sin(yaw, out=vectors[:, 0])
+    np.multiply(vectors[:, 0], cos_pitch, out=vectors[:, 0])
+    np.sin(pitch, out=vectors[:, 1])
+    np.cos(yaw, out=vectors[:, 2])
+    np.multiply(vectors[:, 2], cos_pitch, out=vectors[:, 2])
+    np.negative(vectors, out=vectors)
 
-    x = (-1) * np.cos(pitch) * np.sin(yaw)
-    y = (-1) * np.sin(pitch)
-    z = (-1) * np.cos(pitch) * np.cos(yaw)
+    return vectors
 
-    vectors = np.column_stack((x, y, z))
-    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
 
-    return vectors / norm
+def rodrigues_z_axis(vectors):
+    """
+    Third column of rotation matrices of angle-axis vectors Nx3, the same as `cv2.Rodrigues(vector)[0][:, 2]`.
+
+    R = cos(t) * I + (1 - cos(t)) * k @ k.T + sin(t) * [k]x, where t = |r|, k = r / t
+    Zv = ((1 - cos(t)) / t^2 * rx * rz + sin(t) / t * ry,
+          (1 - cos(t)) / t^2 * ry * rz - sin(t) / t * rx,
+          cos(t) + (1 - cos(t)) / t^2 * rz^2)
+    """
+    vectors = np.asarray(vectors).reshape(-1, 3)
+    rx, ry, rz = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+
+    theta = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    small = theta < 1e-6
+    # limits of (1 - cos(t)) / t^2 and sin(t) / t at zero are 1/2 and 1
+    theta[small] = 1
+    cos_theta = np.cos(theta)
+    a = (1 - cos_theta) / (theta * theta)
+    b = np.sin(theta) / theta
+    cos_theta[small] = 1
+    a[small] = 0.5
+    b[small] = 1
+
+    a_rz = a * rz
+    z_axis = np.empty((len(vectors), 3), dtype=theta.dtype)
+    np.multiply(a_rz, rx, out=z_axis[:, 0])
+    z_axis[:, 0] += b * ry
+    np.multiply(a_rz, ry, out=z_axis[:, 1])
+    z_axis[:, 1] -= b * rx
+    np.multiply(a_rz, rz, out=z_axis[:, 2])
+    z_axis[:, 2] += cos_theta
+    return z_axis
 
 
 def pose3Dto2D(vectors):
@@ -53,21 +91,44 @@ def pose3Dto2D(vectors):
     theta = asin(Zv[1])
     phi = atan2(Zv[0], Zv[2])
     """
+    Zv = rodrigues_z_axis(np.asarray(vectors, dtype=np.float32))
 
-    Zv = np.apply_along_axis(
-        lambda vector: Rodrigues(vector)[0][:, 2],
-        axis=1,
-        arr=vectors.astype(np.float32)
-    ).T
-
-    pitch = np.arcsin(Zv[1])  # pitch
-    yaw = np.arctan2(Zv[0], Zv[2])  # yaw
+    pitch = np.arcsin(Zv[:, 1])  # pitch
+    yaw = np.arctan2(Zv[:, 0], Zv[:, 2])  # yaw
 
     return np.column_stack((yaw, pitch))
 
 
 def angles_between_vectors(vectors1, vectors2):
-    vectors1 = vectors1/np.linalg.norm(vectors1, axis=1).reshape(-1, 1)
-    vectors2 = vectors2/np.linalg.norm(vectors2, axis=1).reshape(-1, 1)
-    return np.arccos(np.sum(np.multiply(vectors1, vectors2), axis=1)).reshape(-1, 1)
-
+    vectors1 = np.asarray(vectors1).reshape(-1, 3)
+    vectors2 = np.asarray(vectors2).reshape(-1, 3)
+    cosines = np.einsum('ij,ij->i', vectors1, vectors2)
+    cosines /= np.sqrt(np.einsum('ij,ij->i', vectors1, vectors1) * np.einsum('ij,ij->i', vectors2, vectors2))
+    return np.arccos(np.clip(cosines, -1, 1, out=cosines)).reshape(-1, 1)
+
+
+if __name__ == '__main__':
+
+    # micro-benchmark: python app/estimation/transform.py
+    from timeit import timeit
+    from cv2 import Rodrigues
+
+    rows = 10 ** 6
+    random = np.random.RandomState(0)
+    poses = (random.randn(rows, 3) * 0.3).astype(np.float32)
+    gazes = random.randn(rows, 3).astype(np.float32)
+    gazes /= np.linalg.norm(gazes, axis=1, keepdims=True)
+    angles = gaze3Dto2D(gazes)
+
+    def rodrigues_loop(vectors):
+        return np.apply_along_axis(lambda vector: Rodrigues(vector)[0][:, 2], axis=1, arr=vectors)
+
+    assert np.allclose(rodrigues_z_axis(poses[:10000]), rodrigues_loop(poses[:10000]), atol=1e-5)
+
+    loop_time = timeit(lambda: rodrigues_loop(poses[:10000]), number=1) * rows / 10000
+    print(f'{"apply_along_axis + Rodrigues":30} {rows / loop_time / 1e6:8.2f} M rows/s (estimated on 1e4 rows)')
+    for name, function in [('pose3Dto2D', lambda: pose3Dto2D(poses)),
+                           ('gaze3Dto2D', lambda: gaze3Dto2D(gazes)),
+                           ('gaze2Dto3D', lambda: gaze2Dto3D(angles)),
+                           ('angles_between_vectors', lambda: angles_between_vectors(gazes, poses))]:
+        print(f'{name:30} {rows / timeit(function, number=5) * 5 / 1e6:8.2f} M rows/s')
@@ -1,5 +1,12 @@
 from numpy import array
-from numpy.linalg import inv
+from numpy import ceil
+from numpy import empty
+from numpy import floor
+from numpy import maximum
+from numpy import minimum
+from numpy import vstack
+from numpy import float32
+from numpy import uint8
 
 from cv2 import circle
 from cv2 import line
@@ -9,7 +16,7 @@ from cv2 import cvtColor
 from cv2 import equalizeHist
 
 from cv2 import projectPoints
-from cv2 import findHomography
+from cv2 import getPerspectiveTransform
 from cv2 import warpPerspective
 
 from cv2 import COLOR_RGB2GRAY
@@ -46,7 +53,7 @@ class Frame:
     def get_projected_coordinates(self, vectors):
         return projectPoints(vectors,
                              -self.camera.rotation,
-                             -(inv(self.camera.get_rotation_matrix()) @ self.camera.translation),
+                             self.camera.get_inverse_translation(),
                              self.camera.matrix,
                              self.camera.distortion)[0].reshape(-1, 2)
 
@@ -70,33 +77,58 @@ class Frame:
         """
         return self.image[coord[0]:coord[0]+shape[0], coord[1]:coord[1]+shape[1]]
 
-    def extract_eyes_from_person(self, person, resolution=(60, 36), equalize_hist=False, to_grayscale=False, remove_specularity=False):
-        # eye planes
-        left_norm_image_plane = array([[resolution[0], 0.0          ],
-                                        [0.0,           0.0          ],
-                                        [0.,            resolution[1]],
-                                        [resolution[0], resolution[1]]])
-        right_norm_image_plane = array([[0.0,          0.0          ],
-                                         [resolution[0], 0.0         ],
-                                         [resolution[0], resolution[1]],
-                                         [0.,            resolution[1]]])
+    # corners of normalized eye images in order of Person.get_eye_rectangle, left eye is mirrored
+    _norm_image_planes = {
+        'left': array([[1.0, 0.0], [0.0, 0.0], [0.0, 1.0], [1.0, 1.0]], dtype=float32),
+        'right': array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]], dtype=float32)
+    }
 
-        left_eye_projection = self.get_projected_coordinates(person.get_eye_rectangle('left'))
-        right_eye_projection = self.get_projected_coordinates(person.get_eye_rectangle('right'))
-
-        homography, status = findHomography(left_eye_projection, left_norm_image_plane)
-        left_eye_frame = warpPerspective(self.image, homography, resolution)
-
-        homography, status = findHomography(right_eye_projection, right_norm_image_plane)
-        right_eye_frame = warpPerspective(self.image, homography, resolution)
-
-        if to_grayscale:
-            left_eye_frame, right_eye_frame = cvtColor(left_eye_frame, COLOR_RGB2GRAY), \
-                                              cvtColor(right_eye_frame, COLOR_RGB2GRAY)
-        if equalize_hist:
-            left_eye_frame, right_eye_frame = equalizeHist(left_eye_frame), equalizeHist(right_eye_frame)
+    def extract_eyes_from_person(self, person, resolution=(60, 36), equalize_hist=False, to_grayscale=False,
+                                 remove_specularity=False, out=None):
+        """
+        Extracts normalized images of both eyes in one pass.
+        Both eye rectangles are projected at once, only bounding box of each rectangle is converted to grayscale
+        and warped directly into `out`.
+        :param resolution: tuple (width, height) of eye images
+        :param out: preallocated uint8 array 2 x height x width (x channels if not to_grayscale) for left and right
+            eye images, None - allocate new one
+        :return: left and right eye images, views of `out`
+        """
+        convert = to_grayscale and self.image.ndim == 3
+        if out is None:
+            channels = () if to_grayscale else self.image.shape[2:]
+            out = empty((2, resolution[1], resolution[0], *channels), dtype=uint8)
+
+        eye_projections = self.get_projected_coordinates(
+            vstack([person.get_eye_rectangle('left').reshape(-1, 3),
+                    person.get_eye_rectangle('right').reshape(-1, 3)])
+        ).astype(float32)
+
+        height, width = self.image.shape[:2]
+        size = array(resolution, dtype=float32)
+        for i, eye in enumerate(['left', 'right']):
+            eye_projection = eye_projections[4 * i:4 * i + 4]
+
+            # bounding box of the eye with a pixel for interpolation, out of image pixels stay black
+            x_min, y_min = maximum(floor(eye_projection.min(axis=0)).astype(int) - 1, 0)
+            x_max, y_max = minimum(ceil(eye_projection.max(axis=0)).astype(int) + 2, (width, height))
+            if x_min >= x_max or y_min >= y_max:
+                out[i] = 0
+                continue
+
+            # exact transform of 4 points, shifted to the bounding box
+            homography = getPerspectiveTransform(eye_projection - array([x_min, y_min], dtype=float32),
+                                                 self._norm_image_planes[eye] * size)
+            eye_region = self.image[y_min:y_max, x_min:x_max]
+            if convert:
+                # converting the small region is cheaper than the full frame, and only one channel is warped
+                eye_region = cvtColor(eye_region, COLOR_RGB2GRAY)
+            warpPerspective(eye_region, homography, resolution, dst=out[i])
+            if equalize_hist:
+                equalizeHist(out[i], dst=out[i])
 
         if remove_specularity:
-            left_eye_frame, right_eye_frame = rm_specularity(left_eye_frame), rm_specularity(right_eye_frame)
+            # both eyes at once
+            rm_specularity(out, out=out)
 
-        return left_eye_frame, right_eye_frame
+        return out[0], out[1]
@@ -1,4 +1,4 @@
-def gather(dataset_path, face_detector, scene, person_name, dataset_size, size='_72_120'):
+def gather(dataset_path, face_detector, scene, person_name, dataset_size, size='_72_120', pipeline=1, processes=0):
 
     from app.utils import experiment_without_BRS
 
@@ -7,4 +7,6 @@ def gather(dataset_path, face_detector, scene, person_name, dataset_size, size='
                            scene,
                            person_name,
                            size=size,
-                           dataset_size=dataset_size)
+                           dataset_size=int(dataset_size),
+                           pipeline=bool(int(pipeline)),
+                           processes=int(processes) or None)
@@ -2,46 +2,167 @@ from app import SessionReader
 from app import Person
 import numpy as np
 import os
+from multiprocessing import Pool
+from os import cpu_count
 from tqdm import tqdm
 
 
-def get_data_coord(data, sep=','):
-    result = ''
-    if isinstance(data, dict):
-        for axis, value in data.items():
-            value = str(int(value)) if not value % 1 else format(value, '.9f')
-            result += value + sep
-    elif isinstance(data, list):
-        for axis, value in zip('XYZ', data):
-            value = str(int(value)) if not value % 1 else format(value, '.9f')
-            result += value + sep
-    return result
-
-
-def get_line(data, title=False, sep=','):
-    result = ''
+def get_columns(data):
+    """
+    Columns of result.csv for snapshot data.
+    Dicts of coordinates give columns `key + axis`, lists of them give `key + index + axis`, ints give `key`.
+    """
+    columns = []
     for key, value in data.items():
         if isinstance(value, dict):
-            if title:
-                for axis in value.keys():
-                    result += key + axis + sep
-            else:
-                result += get_data_coord(value)
+            columns.extend(key + axis for axis in value)
         elif isinstance(value, list):
             for i, item in enumerate(value):
-                if title:
-                    for axis in item.keys():
-                        result += key + str(i) + axis + sep
-                else:
-                    result += get_data_coord(item, sep=sep)
-        elif isinstance(value, int):
-            if title:
-                result += key + sep
-            else:
-                result += str(value) + sep
+                columns.extend(key + str(i) + axis for axis in item)
+        elif isinstance(value, (int, np.integer)):
+            columns.append(key)
         else:
-            raise Exception
-    return result[:-1]
+            raise Exception(f'Unsupported value of "{key}": {value}')
+    return columns
+
+
+def get_values(data):
+    """
+    Values of snapshot data in order of get_columns.
+    """
+    values = []
+    for value in data.values():
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, list):
+            for item in value:
+                values.extend(item.values())
+        else:
+            values.append(value)
+    return values
+
+
+# a cell is written as 4-byte words: sign, six groups of three digits and a separator, unused bytes are zero;
+# DIGIT_GROUPS[1000 * kept + group] is a group with `kept` last digits,
+# the free fourth byte of the third group is the point
+DIGIT_GROUPS = np.zeros((4, 1000, 4), dtype=np.uint8)
+for _kept in range(1, 4):
+    DIGIT_GROUPS[_kept, :, 3 - _kept:3] = np.array([list(b'%03d' % group) for group in range(1000)])[:, 3 - _kept:]
+DIGIT_GROUPS = DIGIT_GROUPS.view('<u4').ravel()
+POINT = np.frombuffer(b'\0\0\0.', dtype='<u4')[0]
+MINUS = np.frombuffer(b'-\0\0\0', dtype='<u4')[0]
+POWERS = 10 ** np.arange(18, dtype=np.int64)
+
+
+def _format_row(row, row_integral, sep):
+    return sep.join('%d' if cell else '%.9f' for cell in row_integral) % tuple(row)
+
+
+def _pack(text, words):
+    return np.frombuffer(text.ljust(4 * words, b'\0'), dtype='<u4')
+
+
+def format_rows(values, sep=','):
+    """
+    Formats rows of values: integral values as integers, other ones with 9 decimals, as `%d` and `%.9f` do.
+
+    All cells are formatted at once with numpy: integers and floats multiplied by 1e9 are split into groups of
+    three digits, which are looked up as bytes without leading zeros and written to one buffer. Rows with cells
+    which are not exact in int64 arithmetic (large values, values next to a rounding tie) are formatted by `%`.
+    :param values: array rows x columns
+    :return: lines of csv
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rows, columns = values.shape
+    with np.errstate(invalid='ignore', over='ignore'):
+        finite = np.isfinite(values)
+        integral = finite & (values % 1 == 0)
+        scaled = np.where(integral, np.abs(values), np.abs(values) * 1e9)
+        tie = np.abs(scaled - np.floor(scaled) - 0.5) <= 2 * np.spacing(scaled)
+        exact = finite & (scaled < 1e18) & (integral | ~tie)
+    slow_rows = np.flatnonzero((finite & ~exact).any(axis=1))
+
+    mantissa = np.rint(np.where(exact, scaled, 0)).astype(np.int64)
+    # integers keep at least one digit, floats keep at least one digit before the point
+    length = np.maximum(np.searchsorted(POWERS, mantissa, side='right'), np.where(integral, 1, 10))
+
+    separator = sep.encode()
+    separator_words = -(-len(separator) // 4)
+    words = np.empty((rows, columns, 7 + separator_words), dtype='<u4')
+    words[..., 0] = np.where(values < 0, MINUS, 0)
+    groups = np.empty((6, rows, columns), dtype=np.int64)
+    rest = mantissa
+    for group in range(5, -1, -1):
+        rest, groups[group] = np.divmod(rest, 1000)
+    for group in range(6):
+        kept = np.clip(length - (15 - 3 * group), 0, 3)
+        words[..., 1 + group] = DIGIT_GROUPS.take(1000 * kept + groups[group])
+    words[..., 3] |= np.where(integral, 0, POINT)
+
+    # nan and inf are written instead of digits
+    for text, cells in [(b'nan', np.isnan(values)), (b'inf', np.isinf(values))]:
+        words[cells, 1:7] = _pack(text, 6)
+    words[:, :-1, 7:] = _pack(separator, separator_words)
+    words[:, -1, 7:] = _pack(b'\n', separator_words)
+
+    lines = words.tobytes().translate(None, b'\0').decode().split('\n')[:rows]
+    for row in slow_rows:
+        lines[row] = _format_row(values[row].tolist(), integral[row], sep)
+    return lines
+
+
+class MetaWriter:
+    """
+    Writes rows of snapshot data to csv file while they are produced.
+    Columns are fixed by the first row, rows are formatted and flushed by `flush_every` rows.
+
+    Examples
+    --------
+
+    >>> with MetaWriter('result.csv') as writer:
+    >>>     writer.write(data)
+    """
+
+    def __init__(self, path, sep=',', flush_every=256):
+        self.path = path
+        self.sep = sep
+        self.flush_every = flush_every
+        self.keys = None
+        self.columns = None
+        self.rows = []
+        self.file = open(path, 'w')
+
+    def write(self, data):
+        if self.columns is None:
+            self.keys = list(data)
+            self.columns = get_columns(data)
+            self.file.write(self.sep.join(self.columns) + '\n')
+        elif list(data) != self.keys:
+            # keep order of columns of the first row
+            data = {key: data[key] for key in self.keys}
+        values = get_values(data)
+        if len(values) != len(self.columns):
+            raise Exception(f'Row has columns {get_columns(data)}, expected {self.columns}')
+        self.rows.append(values)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.file.write('\n'.join(format_rows(self.rows, sep=self.sep)) + '\n')
+            self.rows = []
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def to_xyz_dict(array):
@@ -52,7 +173,7 @@ def norm(vector):
     return vector / np.linalg.norm(vector)
 
 
-def form_data(snapshot, face_detector, scene):
+def form_data(snapshot, face_detector, scene, persons_dlib=None):
 
     dlib_indices = {
         'eyeInnerCornerRight2d': 39,
@@ -72,7 +193,8 @@ def form_data(snapshot, face_detector, scene):
 
     frame_basler = snapshot['frames']['basler']
 
-    persons_dlib = face_detector.detect_persons(frame_basler, origin=scene.origin)
+    if persons_dlib is None:
+        persons_dlib = face_detector.detect_persons(frame_basler, origin=scene.origin)
 
     person_kinect = Person('kinect', origin=scene.origin)
     person_kinect.set_kinect_landmarks3d(snapshot['data']['face_points'])
@@ -99,46 +221,71 @@ def form_data(snapshot, face_detector, scene):
     return data
 
 
-def write_meta_data(session_path, output_path, face_detector, scene, markers, markers_idx):
+def write_meta_data(session_path, output_path, face_detector, scene, markers, markers_idx, prefetch=0, batch_size=64,
+                    processes=None, progress_bar=True):
 
     session_code = os.path.split(session_path)[-1]
+    # workers are forked before reading threads are started
+    processes = face_detector.open_pool(processes)
 
     parser = SessionReader()
     parser.fit(session_code, session_path, scene.cams)
     markers = np.array(markers)
 
-    csv_data = ''
-    write_title = True
-
-    # iterate on data
-    for idx, marker, ((frames, data), i) in zip(markers_idx, markers, parser.snapshots_iterate(progress_bar=True)):
-
-        snapshot = {
-            'frames': frames,
-            'data': data,
-            'gaze': marker
-        }
-
-        data = form_data(snapshot, face_detector=face_detector, scene=scene)
-
-        if data:
-            data['markerId'] = int(idx)
-            line = get_line(data)
-
-            # write title if first line
-            if write_title:
-                title = get_line(data, title=True)
-                csv_data += title + '\n'
-                write_title = False
-
-            csv_data += line + '\n'
-
-    # write data
-    with open(os.path.join(output_path, session_code, 'result.csv'), 'w') as file:
-        file.write(csv_data)
-
-
-def meta(scene, face_detector, dataset_path, markers_json, output_path=None):
+    # iterate on data, faces are tracked through snapshots of the session,
+    # persons of a batch are detected by worker processes, rows are written while they are produced
+    face_detector.reset()
+    # snapshots after the last marker are not read
+    indices = range(min(len(parser.snapshots), len(markers)))
+    batches = parser.batches_iterate(batch_size, indices=indices, progress_bar=progress_bar, prefetch=prefetch,
+                                     cam_names=['basler'])
+    samples = zip(markers_idx, markers)
+    with MetaWriter(os.path.join(output_path, session_code, 'result.csv')) as writer:
+        for batch in batches:
+            batch = [(idx, marker, frames, data) for ((frames, data), i), (idx, marker) in zip(batch, samples)]
+            persons_batch = face_detector.detect_persons_batch([frames['basler'] for _, _, frames, _ in batch],
+                                                               scene.origin, processes=processes)
+            for (idx, marker, frames, data), persons_dlib in zip(batch, persons_batch):
+
+                snapshot = {
+                    'frames': frames,
+                    'data': data,
+                    'gaze': marker
+                }
+
+                data = form_data(snapshot, face_detector=face_detector, scene=scene, persons_dlib=persons_dlib)
+
+                if data:
+                    data['markerId'] = int(idx)
+                    writer.write(data)
+    parser.close()
+    return session_code
+
+
+# detector and scene of a worker process, see meta
+_worker_face_detector = None
+_worker_scene = None
+
+
+def _init_worker(face_detector, scene):
+    global _worker_face_detector, _worker_scene
+    _worker_face_detector, _worker_scene = face_detector, scene
+
+
+def _write_session_meta_data(args):
+    # sessions are processed in parallel, so persons are detected in the worker itself
+    session_path, output_path, markers, markers_idx, prefetch, batch_size = args
+    return write_meta_data(session_path, output_path, _worker_face_detector, _worker_scene, markers, markers_idx,
+                           prefetch=prefetch, batch_size=batch_size, processes=1, progress_bar=False)
+
+
+def meta(scene, face_detector, dataset_path, markers_json, output_path=None, prefetch=0, batch_size=64,
+         processes=0):
+    """
+    Writes result.csv for each session of the dataset.
+    Several sessions are processed in a pool of `processes` workers, each with its own SessionReader and detector,
+    a single session is processed with detection of persons in `processes` workers. 0 - number of cores.
+    """
 
     if not output_path:
         output_path = dataset_path
@@ -154,6 +301,17 @@ def meta(scene, face_detector, dataset_path, markers_json, output_path=None):
                 markers_idx.extend([counter] * 100)
                 counter += 1
 
-    for session in sorted(os.listdir(dataset_path)):
-        session_path = os.path.join(dataset_path, session)
-        write_meta_data(session_path, output_path, face_detector, scene, markers, markers_idx)
+    prefetch, batch_size, processes = int(prefetch), int(batch_size), int(processes) or cpu_count() or 1
+    session_paths = [os.path.join(dataset_path, session) for session in sorted(os.listdir(dataset_path))]
+
+    if len(session_paths) < 2 or processes == 1:
+        for session_path in session_paths:
+            write_meta_data(session_path, output_path, face_detector, scene, markers, markers_idx, prefetch=prefetch,
+                            batch_size=batch_size, processes=processes)
+        face_detector.close()
+        return
+
+    tasks = [(session_path, output_path, markers, markers_idx, prefetch, batch_size) for session_path in session_paths]
+    with Pool(min(processes, len(session_paths)), initializer=_init_worker, initargs=(face_detector, scene)) as pool:
+        for session_code in tqdm(pool.imap_unordered(_write_session_meta_data, tasks), total=len(tasks)):
+            print(f'Meta data of session {session_code} is written')
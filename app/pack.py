@@ -0,0 +1,10 @@
+def pack(dataset_path, *args, **kwargs):
+
+    import os
+    from app.parser.archive import pack_session
+
+    for session in sorted(os.listdir(dataset_path)):
+        session_path = os.path.join(dataset_path, session)
+        if os.path.isdir(os.path.join(session_path, 'DataSource')):
+            print(f'Packing {session_path}')
+            pack_session(session_path)
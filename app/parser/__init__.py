@@ -4,13 +4,25 @@ from os import listdir
 import json
 import bson
 
+from io import BytesIO
+from io import StringIO
+
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
 from cv2 import imread
+from cv2 import imdecode
 from cv2 import flip
 from cv2 import blur
+from cv2 import IMREAD_COLOR
 
 from app.frame import Frame
+from app.parser.archive import SessionArchive
 
 from numpy import array
+from numpy import frombuffer
+from numpy import uint8
 from numpy import sqrt
 from numpy import zeros
 
@@ -42,6 +54,31 @@ def quaternion_to_angle_axis(quaternion):
         return zeros((3, 1))
 
 
+class LazyFrames(Mapping):
+    """
+    Frames of one snapshot, each frame is read and decoded only on the first access.
+    """
+
+    def __init__(self, reader, snapshot, cam_names):
+        self._reader = reader
+        self._snapshot = snapshot
+        self._cam_names = list(cam_names)
+        self._frames = {}
+
+    def __getitem__(self, cam_name):
+        if cam_name not in self._cam_names:
+            raise KeyError(cam_name)
+        if cam_name not in self._frames:
+            self._frames[cam_name] = self._reader.read_frame(self._reader.cams[cam_name], self._snapshot)
+        return self._frames[cam_name]
+
+    def __iter__(self):
+        return iter(self._cam_names)
+
+    def __len__(self):
+        return len(self._cam_names)
+
+
 class SessionReader:
 
     cams_map = {
@@ -75,6 +112,9 @@ class SessionReader:
         self.cam_dirs = {}
         self.data_dirs = {}
 
+        # packed device directories, dir_name -> SessionArchive
+        self.archives = {}
+
         # snapshots data
         self.snapshots = None
 
@@ -88,6 +128,7 @@ class SessionReader:
         self.session_code = session_code
         self.path_to_data = Path.join(path_to_dataset, 'DataSource')
         self.read_device_mapping(path_to_dataset=path_to_dataset)
+        self.open_archives()
 
         self.cams = cams
 
@@ -96,10 +137,27 @@ class SessionReader:
         else:
             source = self.data_dirs
 
-        self.snapshots = sorted([
-            Path.splitext(frame_index)[0]
-            for frame_index in listdir(Path.join(self.path_to_data, source[by]))
-        ])
+        if source[by] in self.archives:
+            file_names = self.archives[source[by]].names
+        else:
+            file_names = listdir(Path.join(self.path_to_data, source[by]))
+
+        self.snapshots = sorted([Path.splitext(frame_index)[0] for frame_index in file_names])
+
+    def open_archives(self):
+        """
+        Uses packed device directories (see app.parser.archive) instead of folders when they exist.
+        """
+        self.close()
+        for dir_name in list(self.cam_dirs.values()) + list(self.data_dirs.values()):
+            path = Path.join(self.path_to_data, dir_name)
+            if SessionArchive.exists(path):
+                self.archives[dir_name] = SessionArchive(path)
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives = {}
 
     def read_device_mapping(self, path_to_dataset):
 
@@ -123,7 +181,8 @@ class SessionReader:
                 pass
 
         # if there is data from BRS.GazeEstimation
-        if Path.exists(Path.join(self.path_to_data, 'cam_100')):
+        if Path.exists(Path.join(self.path_to_data, 'cam_100')) or \
+                SessionArchive.exists(Path.join(self.path_to_data, 'cam_100')):
             self.data_dirs['est_gazes'] = 'cam_100'
 
     def get_cams(self):
@@ -132,21 +191,50 @@ class SessionReader:
     def get_data_sources(self):
         return [data_source for data_source in self.data_dirs.keys()]
 
-    def read_frame(self, cam, snapshot, ext='png'):
-        frame_file = Path.join(self.path_to_data, self.cam_dirs[cam.name], snapshot + '.' + ext)
+    def read_image(self, dir_name, file_name):
+        archive = self.archives.get(dir_name)
+        if archive is not None:
+            buffer = archive.read(file_name)
+            if buffer is None:
+                return None
+            return imdecode(frombuffer(buffer, dtype=uint8), IMREAD_COLOR)
+        frame_file = Path.join(self.path_to_data, dir_name, file_name)
         if Path.isfile(frame_file):
+            return imread(frame_file)
+        return None
+
+    def open_data(self, dir_name, file_name, mode):
+        archive = self.archives.get(dir_name)
+        if archive is None:
+            return open(Path.join(self.path_to_data, dir_name, file_name), mode)
+        buffer = archive.read(file_name)
+        if buffer is None:
+            raise FileNotFoundError(Path.join(self.path_to_data, dir_name, file_name))
+        return BytesIO(buffer) if 'b' in mode else StringIO(buffer.decode())
+
+    def read_frame(self, cam, snapshot, ext='png'):
+        image = self.read_image(self.cam_dirs[cam.name], snapshot + '.' + ext)
+        if image is not None:
             if cam.name == 'web_cam':
-                image = flip(imread(frame_file), 0)
+                image = flip(image, 0)
             elif cam.name == 'basler':
-                image = blur(flip(imread(frame_file), 1), (3, 3))
+                image = blur(flip(image, 1), (3, 3))
             else:
-                image = flip(imread(frame_file), 1)
+                image = flip(image, 1)
             return Frame(cam, image)
         else:
             return None
 
-    def read_frames(self, snapshot):
-        return {cam_name: self.read_frame(self.cams[cam_name], snapshot) for cam_name, cam_dir in self.cam_dirs.items()}
+    def read_frames(self, snapshot, cam_names=None, lazy=False):
+        """
+        :param cam_names: cameras to read, None - all cameras of the session
+        :param lazy: return LazyFrames which decode each frame on the first access
+        """
+        if cam_names is None:
+            cam_names = self.cam_dirs.keys()
+        if lazy:
+            return LazyFrames(self, snapshot, cam_names)
+        return {cam_name: self.read_frame(self.cams[cam_name], snapshot) for cam_name in cam_names}
 
     @staticmethod
     def load_json_data(file, data_key):
@@ -204,7 +292,7 @@ class SessionReader:
                 ext = '.dat'
                 mode = 'rb'
             try:
-                with open(Path.join(self.path_to_data, data_dir, snapshot + ext), mode) as file:
+                with self.open_data(data_dir, snapshot + ext, mode) as file:
                     data[data_key] = self.load_json_data(file, data_key)
             except FileNotFoundError:
                 # TODO add logger
@@ -217,14 +305,19 @@ class SessionReader:
                 data[data_key] = None
         return data
 
-    def read_snapshot(self, snapshot, verbose):
-        return self.read_frames(snapshot), self.read_data(snapshot, verbose)
+    def read_snapshot(self, snapshot, verbose, cam_names=None, lazy=False):
+        return self.read_frames(snapshot, cam_names=cam_names, lazy=lazy), self.read_data(snapshot, verbose)
 
-    def snapshots_iterate(self, indices=None, verbose=0, progress_bar=False, let_none=False):
+    def snapshots_iterate(self, indices=None, verbose=0, progress_bar=False, let_none=False, prefetch=0, workers=2,
+                          cam_names=None, lazy=False):
         """
         Dataset generator
         :param indices: indices of snapshots, according to BRS
         :param verbose: 0 - nothing, 1 - warnings
+        :param prefetch: number of snapshots read ahead in background, 0 - read on the caller's thread
+        :param workers: number of reading threads, used only with prefetch
+        :param cam_names: cameras to read, None - all cameras of the session
+        :param lazy: decode frames on the first access, with prefetch lazy frames are decoded by the consumer
         :return: yield tuple(frame, face_points, faces_rotations)
         """
         if not progress_bar:
@@ -233,11 +326,58 @@ class SessionReader:
             bar = tqdm
         if indices is None:
             indices = range(len(self.snapshots))
+        if prefetch:
+            yield from self._prefetch_iterate(indices, verbose, prefetch, workers, cam_names, lazy, progress_bar)
+            return
         for i in bar(indices):
             snapshot_index = self.snapshots[i]
-            snapshot_data = self.read_snapshot(snapshot_index, verbose)
+            snapshot_data = self.read_snapshot(snapshot_index, verbose, cam_names=cam_names, lazy=lazy)
             yield snapshot_data, snapshot_index
 
+    def batches_iterate(self, batch_size, **kwargs):
+        """
+        Groups snapshots of snapshots_iterate into lists of `batch_size` snapshots, the last one may be shorter.
+        :param kwargs: arguments of snapshots_iterate
+        :return: yield list of tuple(snapshot data, snapshot index)
+        """
+        batch = []
+        for snapshot in self.snapshots_iterate(**kwargs):
+            batch.append(snapshot)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _prefetch_iterate(self, indices, verbose, prefetch, workers, cam_names, lazy, progress_bar=False):
+        """
+        Reads snapshots in a thread pool, keeping at most `prefetch` snapshots ahead of the consumer.
+        Snapshots are yielded in the order of `indices`, the progress bar counts yielded snapshots.
+        """
+        pending = deque()
+        bar = tqdm(total=len(indices)) if progress_bar else None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for i in indices:
+                    snapshot_index = self.snapshots[i]
+                    future = executor.submit(self.read_snapshot, snapshot_index, verbose, cam_names, lazy)
+                    pending.append((future, snapshot_index))
+                    if len(pending) > prefetch:
+                        future, snapshot_index = pending.popleft()
+                        if bar is not None:
+                            bar.update()
+                        yield future.result(), snapshot_index
+                while pending:
+                    future, snapshot_index = pending.popleft()
+                    if bar is not None:
+                        bar.update()
+                    yield future.result(), snapshot_index
+            finally:
+                # consumer stopped early, drop snapshots which are not read yet
+                for future, _ in pending:
+                    future.cancel()
+                if bar is not None:
+                    bar.close()
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,100 @@
+from os import path as Path
+from os import listdir
+
+from mmap import mmap
+from mmap import ACCESS_READ
+
+import json
+
+
+class SessionArchive:
+    """
+    Read-only access to a device directory packed with `pack_directory`.
+
+    The directory is stored as two files next to it:
+        <dir>.pack -- contents of all files, one after another;
+        <dir>.idx -- json with sorted file names and their offsets and sizes in <dir>.pack.
+    """
+
+    data_ext = '.pack'
+    index_ext = '.idx'
+
+    def __init__(self, path):
+        with open(path + self.index_ext, mode='r') as index_file:
+            index = json.load(index_file)
+
+        # names are sorted while packing
+        self.names = index['names']
+        self.index = {name: (offset, size) for name, offset, size in zip(index['names'],
+                                                                          index['offsets'],
+                                                                          index['sizes'])}
+
+        self._file = open(path + self.data_ext, mode='rb')
+        if Path.getsize(path + self.data_ext):
+            self._data = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        else:
+            # empty files can not be mapped
+            self._data = b''
+
+    @classmethod
+    def exists(cls, path):
+        return Path.isfile(path + cls.data_ext) and Path.isfile(path + cls.index_ext)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def read(self, name):
+        """
+        :param name: file name inside of packed directory
+        :return: bytes of the file or None if there is no such file
+        """
+        location = self.index.get(name)
+        if location is None:
+            return None
+        offset, size = location
+        return self._data[offset:offset + size]
+
+    def close(self):
+        if isinstance(self._data, mmap):
+            self._data.close()
+        self._file.close()
+
+
+def pack_directory(path, chunk_size=1 << 20):
+    """
+    Packs all files of directory into <path>.pack and <path>.idx, the directory itself stays untouched.
+    :param path: path to directory
+    :param chunk_size: size of chunks in bytes used for copying
+    :return: path to packed data
+    """
+    path = Path.normpath(path)
+    names = sorted(name for name in listdir(path) if Path.isfile(Path.join(path, name)))
+    offsets, sizes = [], []
+
+    with open(path + SessionArchive.data_ext, mode='wb') as pack:
+        for name in names:
+            offsets.append(pack.tell())
+            with open(Path.join(path, name), mode='rb') as file:
+                chunk = file.read(chunk_size)
+                while chunk:
+                    pack.write(chunk)
+                    chunk = file.read(chunk_size)
+            sizes.append(pack.tell() - offsets[-1])
+
+    # index is written last, so partly packed directory is never used
+    with open(path + SessionArchive.index_ext, mode='w') as index:
+        json.dump({'names': names, 'offsets': offsets, 'sizes': sizes}, fp=index)
+
+    return path + SessionArchive.data_ext
+
+
+def pack_session(path_to_dataset, chunk_size=1 << 20):
+    """
+    Packs every device directory of session's DataSource.
+    :param path_to_dataset: path to session, folder with DataSource and DeviceMapping.txt
+    :return: list of paths to packed data
+    """
+    path_to_data = Path.join(path_to_dataset, 'DataSource')
+    return [pack_directory(Path.join(path_to_data, dir_name), chunk_size=chunk_size)
+            for dir_name in sorted(listdir(path_to_data))
+            if Path.isdir(Path.join(path_to_data, dir_name))]
@@ -0,0 +1,214 @@
+from io import BytesIO
+from os import path as Path
+
+from numpy import asarray
+from numpy import where
+from numpy import empty
+from numpy import isnan
+from numpy import concatenate
+from numpy import searchsorted
+from numpy import diff
+from numpy import load
+from numpy import save
+from numpy import loadtxt
+from numpy import frombuffer
+from numpy import flatnonzero
+from numpy import count_nonzero
+from numpy import add
+from numpy import repeat
+from numpy import float32
+from numpy import float64
+from numpy import int8
+from numpy import int64
+from numpy import uint8
+
+
+# types of columns written by OpenGaze, other columns are float64
+COLUMN_TYPES = {
+    'CNT': int64, 'TIME': float64, 'TIME_TICK': int64,
+    'FPOGS': float64, 'FPOGD': float64, 'FPOGID': int64,
+    'FPOGV': int8, 'LPOGV': int8, 'RPOGV': int8, 'BPOGV': int8,
+    'LPV': int8, 'RPV': int8, 'LPUPILV': int8, 'RPUPILV': int8,
+    'CS': int8, 'USER': 'S64'
+}
+FLOAT_COLUMNS = ['FPOGX', 'FPOGY', 'LPOGX', 'LPOGY', 'RPOGX', 'RPOGY', 'BPOGX', 'BPOGY',
+                 'LPCX', 'LPCY', 'LPD', 'LPS', 'RPCX', 'RPCY', 'RPD', 'RPS',
+                 'LEYEX', 'LEYEY', 'LEYEZ', 'LPUPILD', 'REYEX', 'REYEY', 'REYEZ', 'RPUPILD', 'CX', 'CY']
+COLUMN_TYPES.update({column: float32 for column in FLOAT_COLUMNS})
+
+TAB, NEWLINE, ZERO, NINE = b'\t\n09'
+
+
+def log_dtype(header):
+    return [(column, COLUMN_TYPES.get(column, float64)) for column in header]
+
+
+def _sample_lines(chunk, width):
+    """
+    Drops lines of other width (messages, a line cut by the end of recording), repeated headers and empty lines.
+    Lines are checked with numpy, bytes are copied only if there are such lines.
+    """
+    buffer = frombuffer(chunk, dtype=uint8)
+    tabs = buffer == TAB
+    ends = flatnonzero(buffer == NEWLINE)
+    starts = concatenate([[0], ends[:-1] + 1]).astype(int64)
+    first = buffer[starts]
+    if count_nonzero(tabs) == (width - 1) * len(ends) and ((first >= ZERO) & (first <= NINE)).all():
+        return chunk, buffer, tabs
+    good = (add.reduceat(tabs, starts, dtype=int64) == width - 1) & (first >= ZERO) & (first <= NINE)
+    buffer = buffer[repeat(good, ends - starts + 1)]
+    return buffer.tobytes(), buffer, buffer == TAB
+
+
+def _parse_chunk(chunk, header, dtype):
+    """
+    Converts complete lines of a log to a structured array by one np.loadtxt call.
+    Lines of other width and repeated headers are skipped, empty values are nan for float columns
+    and 0 for integer ones.
+    :param chunk: bytes of lines, each line ends with a newline
+    """
+    if b'\r' in chunk:
+        chunk = chunk.replace(b'\r', b'')
+    if chunk:
+        chunk, buffer, tabs = _sample_lines(chunk, len(header))
+    if not chunk:
+        return empty(0, dtype=dtype)
+
+    if (tabs[:-1] & (tabs[1:] | (buffer[1:] == NEWLINE))).any():
+        # loadtxt does not read empty values, they are nan
+        chunk = chunk.replace(b'\t\t', b'\tnan\t').replace(b'\t\t', b'\tnan\t').replace(b'\t\n', b'\tnan\n')
+    else:
+        try:
+            return loadtxt(BytesIO(chunk), dtype=dtype, delimiter='\t', comments=None, ndmin=1)
+        except ValueError:
+            # e.g. a float in an integer column
+            pass
+
+    # numeric columns are read as float64 to keep nan
+    table = loadtxt(BytesIO(chunk), dtype=[(column, column_type if column_type == 'S64' else float64)
+                                           for column, column_type in dtype],
+                    delimiter='\t', comments=None, ndmin=1)
+    data = empty(len(table), dtype=dtype)
+    for column, column_type in dtype:
+        values = table[column]
+        if column_type == 'S64':
+            values = where(values == b'nan', b'', values)
+        elif data.dtype[column].kind != 'f':
+            values = where(isnan(values), 0, values)
+        data[column] = values
+    return data
+
+
+def iterate_gaze_log(path, chunk_size=1 << 22):
+    """
+    Streams a TSV log of Gazepoint samples, memory does not grow with the size of the log.
+    :param path: path to log.tsv written by OpenGazeTrackerRETTNA
+    :param chunk_size: number of bytes to parse at once
+    :return: yield structured arrays of samples, dtype is `log_dtype` of the header
+    """
+    with open(path, mode='rb') as log_file:
+        header = log_file.readline().rstrip(b'\r\n').decode().split('\t')
+        dtype = log_dtype(header)
+        rest = b''
+        parsed = False
+        while True:
+            chunk = log_file.read(chunk_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            # the last line may continue in the next chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            parsed = True
+            yield _parse_chunk(chunk[:end], header, dtype)
+        if rest or not parsed:
+            yield _parse_chunk(rest + b'\n' if rest else rest, header, dtype)
+
+
+class GazeLog:
+    """
+    Samples of a Gazepoint TSV log as a structured array with an index by TIME.
+
+    Parsed samples are cached to <log>.npy next to the log and loaded from it (memory mapped)
+    while the cache is newer than the log.
+
+    Examples
+    --------
+
+    >>> log = GazeLog('log/log.tsv')
+    >>> gaze = log.between(100., 160.)[['TIME', 'FPOGX', 'FPOGY', 'FPOGV']]
+    """
+
+    cache_ext = '.npy'
+
+    def __init__(self, path, cache=True, chunk_size=1 << 22):
+        self.path = path
+        cache_path = path + self.cache_ext
+        if cache and Path.isfile(cache_path) and Path.getmtime(cache_path) >= Path.getmtime(path):
+            self.data = load(cache_path, mmap_mode='r')
+        else:
+            self.data = concatenate(list(iterate_gaze_log(path, chunk_size=chunk_size)))
+            if cache:
+                save(cache_path, self.data)
+
+        self.time = self.data['TIME']
+        # TIME of the tracker goes up within a log, but rows of restarted recordings are sorted to be sure
+        self.order = None if len(self.time) < 2 or (diff(self.time) >= 0).all() else self.time.argsort(kind='stable')
+        if self.order is not None:
+            self.time = self.time[self.order]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    @property
+    def columns(self):
+        return list(self.data.dtype.names)
+
+    def indices_between(self, start, end):
+        """
+        :return: indices of samples with start <= TIME < end, sorted by TIME
+        """
+        first, last = searchsorted(self.time, [start, end])
+        return self.order[first:last] if self.order is not None else slice(first, last)
+
+    def between(self, start, end):
+        return self.data[self.indices_between(start, end)]
+
+    def nearest(self, times):
+        """
+        :return: indices of samples nearest in TIME to each of `times`
+        """
+        times = asarray(times)
+        after = searchsorted(self.time, times).clip(1, max(len(self.time) - 1, 1))
+        before = after - 1
+        if len(self.time) < 2:
+            nearest = before
+        else:
+            nearest = where(times - self.time[before] <= self.time[after] - times, before, after)
+        return self.order[nearest] if self.order is not None else nearest
+
+
+if __name__ == '__main__':
+
+    # parsing and loading time of a log: python -m app.parser.gazelog log/log.tsv
+    import sys
+    from timeit import timeit
+    from os import remove
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'log/log.tsv'
+    samples = len(GazeLog(path, cache=False))
+    parse = timeit(lambda: GazeLog(path, cache=False), number=3) / 3
+    # np.loadtxt of the whole file as floats, without skipping messages and empty values
+    with open(path, mode='rb') as log_file:
+        header = log_file.readline().decode().rstrip('\r\n').split('\t')
+    numeric = [i for i, (_, column_type) in enumerate(log_dtype(header)) if column_type != 'S64']
+    baseline = timeit(lambda: loadtxt(path, skiprows=1, delimiter='\t', usecols=numeric), number=3) / 3
+    GazeLog(path)
+    cached = timeit(lambda: GazeLog(path).data['TIME'].sum(), number=3) / 3
+    remove(path + GazeLog.cache_ext)
+    print(f'{samples} samples: parsing {parse * 1e3:.1f} ms ({samples / parse / 1e3:.0f} k samples/s), '
+          f'np.loadtxt {baseline * 1e3:.1f} ms ({samples / baseline / 1e3:.0f} k samples/s), '
+          f'cache {cached * 1e3:.1f} ms')
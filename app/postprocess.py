@@ -1,8 +1,11 @@
-def postprocess(face_detector, scene, markers_json=None, *args, **kwargs):
+def postprocess(face_detector, scene, markers_json=None, processes=0, *args, **kwargs):
 
     from app import SessionReader
     from app.utils import create_learning_dataset
 
+    # workers are forked before reading threads are started, 0 - number of cores
+    processes = face_detector.open_pool(int(processes) or None)
+
     sess_reader = SessionReader()
     sess_reader.fit('1531844043', r'D:\param_train_sess\17_07_18\1531844043', cams=scene.cams, by='basler')
 
@@ -18,4 +21,6 @@ def postprocess(face_detector, scene, markers_json=None, *args, **kwargs):
                             face_detector,
                             scene,
                             indices=range(len(sess_reader.snapshots)),
-                            markers=markers)
+                            markers=markers,
+                            prefetch=8,
+                            processes=processes)
@@ -2,24 +2,29 @@ from os import path as Path
 import json
 import os.path
 from app.estimation import GazeNet
-from pygaze.display import Display
+from app.estimation import load_gaze_model
 from app import *
 import numpy as np
 import cv2
-import pypylon
 import logging as log
 import time
+import threading
+from collections import deque
+from queue import Full
+import multiprocessing
+from os import cpu_count
 from numpy.linalg import norm
 
 
-def create_video(save_path, name, resolution, frame_rate, parser, callback, indices=None):
+def create_video(save_path, name, resolution, frame_rate, parser, callback, indices=None, cam_names=None):
     if not os.path.exists(save_path):
         os.makedirs(save_path, exist_ok=True)
 
     fourcc = cv2.VideoWriter_fourcc(*'MJPG')
     out = cv2.VideoWriter(Path.join(save_path, name), fourcc, frame_rate, resolution)
 
-    for (frames, data), index in parser.snapshots_iterate(indices=indices, progress_bar=True):
+    snapshots = parser.snapshots_iterate(indices=indices, progress_bar=True, cam_names=cam_names, lazy=True)
+    for (frames, data), index in snapshots:
         image = callback(frames, data)
         if image is not None:
             out.write(image)
@@ -33,6 +38,7 @@ def create_gaze_video(save_path, parser, face_detector, scene, cam_name, indices
     wall_points = np.array([wall.point_to_origin(x, y) for (x, y) in wall_points])
     resolution = (640, 480)
     # model = GazeNet().init('checkpoints/model_700_0.0025.h5')
+    face_detector.reset()
 
     def get_web_cam_image(frames, data):
         if data['face_points']:
@@ -75,13 +81,15 @@ def create_gaze_video(save_path, parser, face_detector, scene, cam_name, indices
             frame.project_vectors(wall_points.reshape(-1, 3))
             return cv2.resize(frame.image, resolution)
 
-    create_video(save_path, f'{cam_name}_{parser.session_code}.avi', resolution, 10.0, parser, get_web_cam_image, indices)
+    create_video(save_path, f'{cam_name}_{parser.session_code}.avi', resolution, 10.0, parser, get_web_cam_image, indices,
+                 cam_names={'basler', 'color', cam_name})
 
 
 def create_wall_video(save_path, parser, face_detector, scene, indices=None):
     wall = scene.screens['wall']
     resolution = tuple((np.array([wall.resolution[1], wall.resolution[0]]) / 2).astype(int))
     # model = GazeNet().init('checkpoints/model_700_0.0025.h5')
+    face_detector.reset()
 
     def get_wall_image(frames, data):
         if data['gazes']:
@@ -115,7 +123,8 @@ def create_wall_video(save_path, parser, face_detector, scene, indices=None):
                                                      colors=[(255, 0, 0), (0, 255, 0)])
             return cv2.resize(image, resolution)
 
-    create_video(save_path, f'wall_{parser.session_code}.avi', resolution, 5.0, parser, get_wall_image, indices)
+    create_video(save_path, f'wall_{parser.session_code}.avi', resolution, 5.0, parser, get_wall_image, indices,
+                 cam_names=['basler'])
 
 
 def validate_calibration(parser, scene, index, face_detector, cam_names=['basler', 'color', 'web_cam']):
@@ -135,7 +144,8 @@ def validate_calibration(parser, scene, index, face_detector, cam_names=['basler
         cv2.resizeWindow(title, 600, 360)
         frame.image = img_copy
 
-    for (frames, data), index in parser.snapshots_iterate(indices=[index], progress_bar=False):
+    face_detector.reset()
+    for (frames, data), index in parser.snapshots_iterate(indices=[index], progress_bar=False, lazy=True):
         frames_to_show = [frames[cam_name] for cam_name in cam_names]
 
         # Kinect landmarks
@@ -177,6 +187,8 @@ def connect_gazepoint():
 
 
 def connect_basler(exposure_time=1000):
+    # camera SDK is imported on demand, so other commands work without it
+    import pypylon
     print(pypylon.factory.find_devices())
     basler = pypylon.factory.create_device(pypylon.factory.find_devices()[0])
     basler.open()
@@ -226,7 +238,7 @@ def init_experiment(save_path, session_code, size, scene, testing=False, path_to
 
     model = None
     if testing:
-        model = GazeNet().init(path_to_model)
+        model = load_gaze_model(path_to_model)
 
     # Logging
     log.basicConfig(filename='log/experiment.log', level=log.INFO)
@@ -234,45 +246,123 @@ def init_experiment(save_path, session_code, size, scene, testing=False, path_to
     return learning_data, wall, basler, tracker, model, save_path
 
 
-def experiment_without_BRS(save_path, face_detector, scene, session_code, dataset_size=1000, size=''):
+def capture_samples(basler, tracker, dataset_size, max_pending=16):
+    """
+    Grabs Basler frames and pairs them with gaze at the moment of grabbing.
+    Frames and Gazepoint samples are timestamped by time.monotonic, gaze is interpolated between the samples
+    around the frame, see GazeAligner. A frame waits until a sample after it is received; frames without
+    valid samples around them are skipped.
+    :param max_pending: number of frames waiting for gaze samples, when samples are late by more frames
+        the oldest frame is dropped and counted
+    :return: yield tuple(raw frame, gaze, frame time, time of the nearest gaze sample)
+    """
+    from app.device.gaze_point import GazeAligner
+
+    aligner = GazeAligner()
+    pending = deque()
+    dropped = 0
+    index = 0
+    while index < dataset_size:
+        frame_basler = next(basler.grab_images(1))
+        frame_time = time.monotonic()
+        aligner.extend(tracker.sample())
+        if frame_basler is not None:
+            if len(pending) == max_pending:
+                pending.popleft()
+                dropped += 1
+                log.warning(f'Gaze samples are late by {max_pending} frames, frame is dropped ({dropped} in total)')
+            pending.append((frame_basler, frame_time))
+
+        while pending and index < dataset_size and pending[0][1] <= aligner.latest_time():
+            frame_basler, frame_time = pending.popleft()
+            gaze, gaze_time = aligner.gaze_at(frame_time)
+            if gaze is None:
+                log.info(f'No valid gaze around frame at {frame_time}')
+                continue
+            log.info(f'Basler time: {frame_time}, GazePoint time: {gaze_time}, difference: {frame_time - gaze_time}')
+            print(f'Frame {index}, {len(pending)} frames wait for gaze samples, {dropped} frames dropped')
+            yield frame_basler, gaze, frame_time, gaze_time
+            index += 1
+
+
+def process_sample(face_detector, scene, wall, frame_basler, gaze, to_grayscale=False):
+    """
+    Detects person on a raw Basler frame and extracts eye patches.
+    :param to_grayscale: grayscale patches, as EyePatchStore keeps them
+    :return: person, left and right eye patches, or None if no persons are found
+    """
+    frame_basler = Frame(scene.cams['basler'], cv2.flip(frame_basler, 1))
+    persons_basler = face_detector.detect_persons(frame_basler, scene.origin)
+    if len(persons_basler) == 0:
+        print('No persons found!')
+        return None
+    person_basler = persons_basler[0]
+    person_basler.set_landmarks3d_gazes(gaze, wall)
+
+    left_eye_frame, right_eye_frame = frame_basler.extract_eyes_from_person(person_basler,
+                                                                            resolution=(120, 72),
+                                                                            equalize_hist=True,
+                                                                            to_grayscale=to_grayscale)
+    return person_basler, left_eye_frame, right_eye_frame
+
+
+def _process_samples(face_detector, scene, wall, samples, results, to_grayscale):
+    """
+    Worker of the pipeline: processes samples until None, then puts None to results.
+    """
+    face_detector.reset()
+    while True:
+        sample = samples.get()
+        if sample is None:
+            break
+        index, frame_basler, gaze, frame_time, gaze_time = sample
+        try:
+            results.put((index, process_sample(face_detector, scene, wall, frame_basler, gaze, to_grayscale)))
+        except Exception as error:
+            log.exception(f'Frame {index} is not processed: {error}')
+            results.put((index, None))
+    results.put(None)
+
+
+def experiment_without_BRS(save_path, face_detector, scene, session_code, dataset_size=1000, size='', use_store=True,
+                           processes=None, pipeline=True, queue_size=32):
+    """
+    Captures a dataset: Basler frames with Gazepoint gazes, and saves normalized eye patches.
+    :param pipeline: process frames by `processes` worker processes while they are captured, memory is bounded
+        by `queue_size` frames; otherwise keep all frames and process them after capture
+    """
 
     learning_data, wall, basler, tracker, _, save_path = init_experiment(save_path, session_code, size, scene, screen='screen')
-    index = 0
-    lag = 1
-    frames_basler = []
-    gazes = []
+    store = EyePatchStore(save_path) if use_store else None
 
     # os.spawnl(os.P_DETACH, 'mpv https://www.youtube.com/watch?v=ynHlGP6iSbI --fs --fs-screen=2')
 
+    if pipeline:
+        _experiment_pipeline(save_path, face_detector, scene, wall, basler, tracker, store, dataset_size,
+                             processes=processes or cpu_count() or 1, queue_size=queue_size)
+        return
+
+    frames_basler = []
+    gazes = []
+
     # Shooting
     try:
-        while index < dataset_size:
-            frame_basler = next(basler.grab_images(1))
-            frame_time = time.time()
-            sample = tracker.sample()
-            gaze_time = time.time()
-            log.info(f'GazePoint time: {gaze_time}, basler time: {frame_time}, difference: {frame_time - gaze_time}')
-            if sample and frame_basler is not None and int(sample[-lag]['FPOGV']):
-                print(f'Lag: {len(sample)} gazepoint samples. Frame {index}')
-                gaze = {
-                    'right': tuple(map(float, (sample[-lag]['LPOGX'], sample[-lag]['LPOGY']))),
-                    'left': tuple(map(float, (sample[-lag]['RPOGX'], sample[-lag]['RPOGY'])))
-                }
-                frame_basler = Frame(scene.cams['basler'], cv2.flip(frame_basler, 1))
-                # show_point(gaze, scene)
-                # cv2.waitKey(1)
-                frames_basler.append(frame_basler)
-                gazes.append(gaze)
-                index += 1
+        for frame_basler, gaze, _, _ in capture_samples(basler, tracker, dataset_size):
+            frame_basler = Frame(scene.cams['basler'], cv2.flip(frame_basler, 1))
+            # show_point(gaze, scene)
+            # cv2.waitKey(1)
+            frames_basler.append(frame_basler)
+            gazes.append(gaze)
     finally:
         basler.close()
         tracker.stop_recording()
         tracker.close()
         cv2.destroyAllWindows()
 
-    # Processing
-    for index, (gaze, frame_basler) in tqdm(enumerate(zip(gazes, frames_basler))):
-        persons_basler = face_detector.detect_persons(frame_basler, scene.origin)
+    # Processing, persons are detected by worker processes
+    face_detector.reset()
+    persons_batch = face_detector.detect_persons_batch(frames_basler, scene.origin, processes=processes)
+    for index, (gaze, frame_basler, persons_basler) in tqdm(enumerate(zip(gazes, frames_basler, persons_batch))):
         if len(persons_basler) == 0:
             print('No persons found!')
             continue
@@ -282,7 +372,7 @@ def experiment_without_BRS(save_path, face_detector, scene, session_code, datase
         left_eye_frame, right_eye_frame = frame_basler.extract_eyes_from_person(person_basler,
                                                                                 resolution=(120, 72),
                                                                                 equalize_hist=True,
-                                                                                to_grayscale=False)
+                                                                                to_grayscale=store is not None)
         # gaze_line_basler = person_basler.get_gaze_line(person_basler.get_eye_gaze('left'), key='left')
         # gaze_intersection = wall.get_intersection_point_in_pixels(gaze_line_basler)
 
@@ -294,13 +384,17 @@ def experiment_without_BRS(save_path, face_detector, scene, session_code, datase
         # cv2.imshow("experiment", image)
         # cv2.waitKey(1)
 
-        cv2.imwrite(Path.join(save_path, f'{index}_left.png'), left_eye_frame)
-        cv2.imwrite(Path.join(save_path, f'{index}_right.png'), right_eye_frame)
+        left_image, right_image = save_eye_patches(save_path, store, index, person_basler, scene.cams['basler'],
+                                                   left_eye_frame, right_eye_frame)
 
         learning_data['dataset'].append(
-            person_basler.to_learning_dataset(f'{index}_left.png', f'{index}_right.png', scene.cams['basler'])
+            person_basler.to_learning_dataset(left_image, right_image, scene.cams['basler'])
         )
 
+    if store is not None:
+        store.close()
+    face_detector.close()
+
     # cv2.destroyAllWindows()
 
     with open(Path.join(save_path, 'normalized_dataset.json'), mode='w') as outfile:
@@ -308,10 +402,93 @@ def experiment_without_BRS(save_path, face_detector, scene, session_code, datase
     print(f"Dataset saved to {save_path}. Number of useful snapshots: {len(learning_data['dataset'])}")
 
 
+def _experiment_pipeline(save_path, face_detector, scene, wall, basler, tracker, store, dataset_size, processes,
+                         queue_size):
+    """
+    Capture thread -> bounded queue -> worker processes (detection, eye extraction) -> this thread writes
+    eye patches and json items while capture goes on.
+    """
+    samples = multiprocessing.Queue(maxsize=queue_size)
+    results = multiprocessing.Queue()
+    # EyePatchStore keeps grayscale patches
+    args = (face_detector, scene, wall, samples, results, store is not None)
+    workers = [multiprocessing.Process(target=_process_samples, args=args, daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    # set when writing stops, the capture thread stops and closes devices
+    stop = threading.Event()
+
+    def put(sample):
+        # blocks while workers are behind, so at most `queue_size` frames wait in memory
+        while not stop.is_set():
+            try:
+                samples.put(sample, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def capture():
+        try:
+            for index, (frame_basler, gaze, frame_time, gaze_time) in enumerate(capture_samples(basler, tracker,
+                                                                                                dataset_size)):
+                if not put((index, frame_basler, gaze, frame_time, gaze_time)):
+                    break
+        finally:
+            basler.close()
+            tracker.stop_recording()
+            tracker.close()
+            for _ in workers:
+                put(None)
+
+    capture_thread = threading.Thread(target=capture, daemon=True)
+    capture_thread.start()
+
+    # Writing results as they come, workers put None when they finish
+    finished = 0
+    try:
+        with LearningDatasetWriter(save_path, scene) as writer, tqdm(total=dataset_size) as bar:
+            while finished < len(workers):
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                index, processed = result
+                bar.update()
+                if processed is None:
+                    continue
+                person_basler, left_eye_frame, right_eye_frame = processed
+                left_image, right_image = save_eye_patches(save_path, store, index, person_basler,
+                                                           scene.cams['basler'], left_eye_frame, right_eye_frame)
+                writer.append(person_basler.to_learning_dataset(left_image, right_image, scene.cams['basler']))
+    finally:
+        # e.g. on KeyboardInterrupt or a failed write: capture stops, workers get sentinels or are terminated
+        stop.set()
+        capture_thread.join()
+        for worker in workers:
+            if worker.is_alive():
+                try:
+                    samples.put_nowait(None)
+                except Full:
+                    pass
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        # frames left in the queue are dropped instead of blocking exit of the process
+        samples.cancel_join_thread()
+        if store is not None:
+            store.close()
+        cv2.destroyAllWindows()
+    print(f"Dataset saved to {save_path}. Number of useful snapshots: {writer.size}")
+
+
 def visualize_predict(face_detector, scene, path_to_model, back=None):
 
     _, wall, basler, tracker, model, _ = init_experiment(save_path=None, session_code=None, size='', scene=scene, testing=True,
                                                       path_to_model=path_to_model, screen='wall')
+    face_detector.reset()
     try:
         while not ispressed(30):
             # sample = tracker.sample()
@@ -326,33 +503,45 @@ def visualize_predict(face_detector, scene, path_to_model, back=None):
                     continue
 
                 image = None
+                rotation = frame_basler.camera.get_rotation_matrix()
 
-                for i, person_basler in enumerate(persons_basler):
-
+                # eye images and head poses of all persons, estimated in one forward pass
+                eye_frames = []
+                norms_to_face = []
+                for person_basler in persons_basler:
                     left_eye_frame, right_eye_frame = frame_basler.extract_eyes_from_person(person_basler,
                                                                                             resolution=(120, 72),
                                                                                             equalize_hist=True,
                                                                                             to_grayscale=False,
                                                                                             remove_specularity=False)
+                    norm_to_face = frame_basler.camera.get_inverse_rotation_matrix() @ (person_basler.get_face_gaze() / norm(person_basler.get_face_gaze())).reshape(3, -1)
+                    eye_frames.extend([left_eye_frame, right_eye_frame])
+                    norms_to_face.extend([norm_to_face, norm_to_face])
+
+                estimated_gazes = (rotation @ model.estimate_gazes(eye_frames, norms_to_face,
+                                                                   eyes=['left', 'right'] * len(persons_basler)).T).T
+
+                # wall intersections of left gaze, right gaze and face normal of all persons in one pass
+                eye_centers = np.array([person_basler.get_eye_center(eye)
+                                        for person_basler in persons_basler for eye in ['left', 'right']]).reshape(-1, 3)
+                noses = np.array([person_basler.get_nose() for person_basler in persons_basler]).reshape(-1, 3)
+                face_gazes = np.array([person_basler.get_face_gaze()
+                                       for person_basler in persons_basler]).reshape(-1, 3)
+                intersections = wall.get_intersection_points_in_pixels(
+                    np.concatenate([eye_centers + estimated_gazes, noses + 50 * face_gazes]),
+                    np.concatenate([eye_centers, noses])
+                )
+                gaze_intersections = intersections[:len(eye_centers)].reshape(-1, 2, 2)
+                face_intersections = intersections[len(eye_centers):]
+
+                for i, person_basler in enumerate(persons_basler):
+
+                    left_eye_frame, right_eye_frame = eye_frames[2 * i], eye_frames[2 * i + 1]
                     # gaze_line_basler = person_basler.get_gaze_line(person_basler.get_eye_gaze('left'))
                     # gaze_intersection = wall.get_intersection_point_in_pixels(gaze_line_basler)
-                    norm_to_face = np.linalg.inv(frame_basler.camera.get_rotation_matrix()) @ (person_basler.get_face_gaze() / norm(person_basler.get_face_gaze())).reshape(3, -1)
-                    gaze_line_left_estimated_basler = person_basler.get_gaze_line(
-                        frame_basler.camera.get_rotation_matrix() @ model.estimate_gaze(left_eye_frame, norm_to_face).reshape(3, -1),
-                        key='left'
-                    )
-                    gaze_line_right_estimated_basler = person_basler.get_gaze_line(
-                        frame_basler.camera.get_rotation_matrix() @
-                        (model.estimate_gaze(cv2.flip(right_eye_frame, 1), norm_to_face * np.array([[-1], [1], [1]])) * np.array([-1, 1, 1])).reshape(3, -1),
-                        key='right'
-                    )
-
-                    face_line_basler = [person_basler.get_nose() + 50 * person_basler.get_face_gaze(),
-                                        person_basler.get_nose()]
-                    gaze_left_estimated_intersection = wall.get_intersection_point_in_pixels(gaze_line_left_estimated_basler)
-                    gaze_right_estimated_intersection = wall.get_intersection_point_in_pixels(gaze_line_right_estimated_basler)
-                    gaze_estimated_intersection = np.array([gaze_left_estimated_intersection, gaze_right_estimated_intersection]).mean(axis=0)
-                    face_intersection = wall.get_intersection_point_in_pixels(face_line_basler)
+                    gaze_left_estimated_intersection, gaze_right_estimated_intersection = gaze_intersections[i]
+                    gaze_estimated_intersection = gaze_intersections[i].mean(axis=0)
+                    face_intersection = face_intersections[i]
                     image = wall.generate_image_with_circles(np.array([face_intersection,
                                                                        # gaze_estimated_intersection,]),#]),
                                                                        gaze_left_estimated_intersection,]),
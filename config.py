@@ -78,7 +78,10 @@ PERSON_DETECTOR = {
     'factor': 1,
     'scale': 1.3,
     'minNeighbors': 5,
-    'chin_nose_distance': 0.065
+    'chin_nose_distance': 0.065,
+    # tracking is turned on only for live capture, see create_live_face_detector of main.py
+    'tracking': False,
+    'redetect_every': 10
 }
 
 DATASET_PARSER = {
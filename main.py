@@ -1,37 +1,80 @@
 import sys
+import time
+from importlib import import_module
 
-from config import *
-from app.estimation import PersonDetector
-from app import Scene
 
-from app.meta import meta
-from app.gather import gather
-from app.traintest import train
-from app.traintest import test
-from app.postprocess import postprocess
-from app.visualize import visualize
+def create_face_detector():
+    from config import PERSON_DETECTOR
+    from app.estimation.persondetector import PersonDetector
+    return PersonDetector(**PERSON_DETECTOR)
 
-face_detector = PersonDetector(**PERSON_DETECTOR)
 
-scene = Scene(origin_name=ORIGIN_CAM, intrinsic_params=INTRINSIC_PARAMS, extrinsic_params=EXTRINSIC_PARAMS)
+def create_live_face_detector():
+    """
+    Faces are tracked between consecutive frames of a camera.
+    """
+    from config import PERSON_DETECTOR
+    from app.estimation.persondetector import PersonDetector
+    return PersonDetector(**dict(PERSON_DETECTOR, tracking=True))
 
+
+def create_scene():
+    from config import ORIGIN_CAM, INTRINSIC_PARAMS, EXTRINSIC_PARAMS
+    from app import Scene
+    return Scene(origin_name=ORIGIN_CAM, intrinsic_params=INTRINSIC_PARAMS, extrinsic_params=EXTRINSIC_PARAMS)
+
+
+def load_markers():
+    from config import MARKERS
+    return MARKERS
+
+
+# command: (module, function, {argument: factory}), modules and arguments are loaded only for the command
 run_dict = {
-    'meta': meta,
-    'visualize': visualize,
-    'postprocess': postprocess,
-    'train': train,
-    'test': test,
-    'gather': gather
+    'meta': ('app.meta', 'meta', {'face_detector': create_face_detector, 'scene': create_scene,
+                                  'markers_json': load_markers}),
+    'visualize': ('app.visualize', 'visualize', {'face_detector': create_live_face_detector, 'scene': create_scene}),
+    'postprocess': ('app.postprocess', 'postprocess', {'face_detector': create_face_detector, 'scene': create_scene,
+                                                       'markers_json': load_markers}),
+    'train': ('app.traintest', 'train', {}),
+    'test': ('app.traintest', 'test', {}),
+    'gather': ('app.gather', 'gather', {'face_detector': create_live_face_detector, 'scene': create_scene}),
+    'pack': ('app.pack', 'pack', {}),
+    'estimate': ('app.estimate', 'estimate', {'face_detector': create_face_detector, 'scene': create_scene})
 }
 
-params = {
-    'meta': {'face_detector': face_detector, 'scene': scene, 'markers_json': MARKERS},
-    'visualize': {'face_detector': face_detector, 'scene': scene},
-    'postprocess': {},
-    'train': {},
-    'test': {},
-    'gather': {}
-}
+
+def load_command(command):
+    """
+    :return: function of the command and its arguments
+    """
+    module, function, factories = run_dict[command]
+    return getattr(import_module(module), function), {name: factory() for name, factory in factories.items()}
+
+
+def startup(commands=None, repeat=3, *args, **kwargs):
+    """
+    Prints time of importing and constructing arguments of commands, each run is a new interpreter.
+    :param commands: comma separated commands, all by default
+    """
+    import subprocess
+
+    code = 'import time; start = time.perf_counter(); import main; main.load_command({!r}); ' \
+           'print(time.perf_counter() - start)'
+    for command in commands.split(',') if commands else run_dict:
+        times = []
+        for _ in range(int(repeat)):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-c', code.format(command)], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=True)
+            if result.returncode:
+                error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode
+                print(f'{command:12} failed: {error}')
+                break
+            times.append((time.perf_counter() - start, float(result.stdout.strip().splitlines()[-1])))
+        else:
+            total, loading = min(times)
+            print(f'{command:12} {total:6.2f} s with interpreter, {loading:6.2f} s of imports and arguments')
 
 
 def main(*args):
@@ -40,9 +83,12 @@ def main(*args):
     print(command)
     print(args)
     kwargs = {arg.split('=')[0]: arg.split('=')[1] for arg in args[2:]}
-    if command:
-        kwargs.update(params[command])
-        run_dict[command](**kwargs)
+    if command == 'startup':
+        startup(**kwargs)
+    elif command:
+        function, params = load_command(command)
+        kwargs.update(params)
+        function(**kwargs)
     else:
         raise Exception
 